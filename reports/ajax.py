@@ -1,17 +1,27 @@
 import logging
 
 from django.shortcuts import render
+from django.views.defaults import page_not_found
 
 from reports import jenkins
+from reports import store
 from reports.circleci import CircleCIClient
+from reports.managerlogs import ManagerLogsNotFound
+from reports.managerlogs import client as manager_logs_client
 from reports.config import instance as config
+from reports.poller import instance as poller
 from views import DEFAULT_MAX_BUILDS
 from views import find_job_definition
+from views import find_nightly_build_or_none
+from views import int_param
+from .menu import instance as menu
 from .jenkins import client as jenkins_client
 
 
 logger = logging.getLogger('django')
 
+LONG_POLL_TIMEOUT = config['jenkins'].get('long_poll_timeout', 25)
+
 
 circleci_projects = config['circleci']['projects']
 
@@ -25,24 +35,91 @@ def unit_tests(request, **_):
 
 
 def job_builds(request, job_name, **_):
+    """The builds of the first page are taken from the build poller. If
+    the version parameter is the current version of the job's builds, the
+    response is delayed until they change or LONG_POLL_TIMEOUT seconds
+    pass. Older pages (the page parameter) are listed using a single range
+    request each, numbered from the newest build."""
     job_def = find_job_definition(job_name)
     full_job_name = '{}/{}'.format(job_def['name'], job_name)
-    job = jenkins_client.get_job(full_job_name, tree='name,lastBuild[number]')
-    last_build_number = job['lastBuild']['number']
-    builds = jenkins_client.get_builds(full_job_name,
-                                       last_build_number,
-                                       size=DEFAULT_MAX_BUILDS)
+    job = jenkins_client.get_job(full_job_name, tree='name')
+    page = max(int_param(request, 'page', 1), 1)
+    try:
+        version, builds = poller.get_builds(
+                full_job_name,
+                version=int_param(request, 'version', -1) if page == 1
+                else None,
+                timeout=LONG_POLL_TIMEOUT if page == 1 else 0)
+    except Exception as e:
+        logger.warning('Polling builds of "{}" failed: {}'.format(
+                full_job_name, str(e)))
+        version = None
+        builds = store.list_builds(full_job_name, size=DEFAULT_MAX_BUILDS)
+    newest_number = builds[0]['number'] if builds else 0
+    if page > 1:
+        # Pages other than the first one are not polled.
+        version = None
+        first_number = newest_number - (page - 1) * DEFAULT_MAX_BUILDS
+        builds = store.list_builds_page(full_job_name,
+                                        first_number,
+                                        DEFAULT_MAX_BUILDS,
+                                        newest_number) \
+            if first_number > 0 else []
+    # Builds may be shared by requests (see cache_result), so reports are
+    # kept by build number rather than set on builds.
+    reports = {}
     for build in builds:
+        # Reports are only available once builds complete.
+        if build['building']:
+            continue
         try:
-            build['report'] = jenkins_client.get_tests_report(
+            reports[build['number']] = store.get_tests_report(
                     full_job_name,
                     build['number'],
-                    tree='passCount,failCount,skipCount')
+                    tree=store.COUNTS_TREE)
         except jenkins.JenkinsResourceNotFound:
             pass
 
     return render(request, 'ajax/job-builds.html', {
         'job': job,
         'job_name': job_name,
-        'builds': builds
+        'builds': builds,
+        'reports': reports,
+        'version': version,
+        'page': page,
+        'has_older_builds': bool(builds) and builds[-1]['number'] > 1
     })
+
+
+def nightly_build(request, job_name, **_):
+    jobs = [x for x in menu.get_jobs() if x['name'] == job_name]
+    if not jobs:
+        return page_not_found(
+                request, ValueError('Unknown job: {}'.format(job_name)))
+    job = jobs[0]
+    nightly_build = find_nightly_build_or_none(job)
+    if nightly_build:
+        job['nightly_build'] = nightly_build
+    return render(request, 'ajax/nightly-build.html', {'job': job})
+
+
+def manager_logs(request, job_name, build_number, suite_name, case_id):
+    job_def = find_job_definition(job_name)
+    if not job_def:
+        return page_not_found(
+                request, ValueError('Unknown job: {}'.format(job_name)))
+    full_job_name = '{}/{}'.format(job_def['name'], job_name)
+    logs = None
+    try:
+        _, case = store.get_tests_report(full_job_name,
+                                         int(build_number)).find_case(case_id)
+        if case is not None:
+            logs = manager_logs_client.get_logs(build_number,
+                                                case.short_class_name,
+                                                case.name)
+    except (jenkins.JenkinsResourceNotFound, ManagerLogsNotFound):
+        pass
+    except Exception as e:
+        logger.warning('Error getting manager logs for {}/{}/{}: {}'.format(
+                full_job_name, build_number, case_id, str(e)))
+    return render(request, 'ajax/manager-logs.html', {'logs': logs})
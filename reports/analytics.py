@@ -0,0 +1,68 @@
+
+import numpy
+
+from reports.history import STATUS_FAILED
+from reports.history import STATUS_MISSING
+from reports.history import STATUS_PASSED
+
+
+class TestTrends(object):
+    """Failure trends of a job's tests over a range of builds, computed
+    over a status matrix of shape (tests, builds) with the oldest build
+    in the first column."""
+
+    def __init__(self, test_names, build_numbers, statuses):
+        self.test_names = test_names
+        self.build_numbers = build_numbers
+        ran = statuses != STATUS_MISSING
+        failed = statuses == STATUS_FAILED
+        self.runs = ran.sum(axis=1)
+        self.failures = failed.sum(axis=1)
+        self.failure_rate = self.failures / numpy.maximum(self.runs, 1.0)
+
+        # A flip is a pass followed by a failure (or vice versa) between
+        # consecutive builds in which the test either passed or failed.
+        decided = failed | (statuses == STATUS_PASSED)
+        pairs = decided[:, 1:] & decided[:, :-1]
+        flips = pairs & (failed[:, 1:] != failed[:, :-1])
+        self.flip_rate = flips.sum(axis=1) / numpy.maximum(
+                pairs.sum(axis=1), 1.0)
+
+        # Length of the current failure streak, counted from the newest
+        # build, and the build in which it started.
+        self.streak = numpy.cumprod(failed[:, ::-1], axis=1).sum(axis=1)
+        newest_first = numpy.array(build_numbers[::-1] or [0])
+        self.first_failing_build = numpy.where(
+                self.streak > 0,
+                newest_first[numpy.maximum(self.streak - 1, 0)],
+                0)
+
+    def top(self, limit=200):
+        """Return the tests which failed at least once as dicts, sorted by
+        failure rate and then by flip rate."""
+        indexes = numpy.flatnonzero(self.failures)
+        order = numpy.lexsort((-self.flip_rate[indexes],
+                               -self.failure_rate[indexes]))
+        return [{
+            'name': self.test_names[i],
+            'runs': int(self.runs[i]),
+            'failures': int(self.failures[i]),
+            'failure_rate': int(round(self.failure_rate[i] * 100)),
+            'flip_rate': int(round(self.flip_rate[i] * 100)),
+            'streak': int(self.streak[i]),
+            'first_failing_build': int(self.first_failing_build[i]) or None
+        } for i in indexes[order][:limit]]
+
+
+def status_matrix(identities, columns):
+    """Build a (tests, builds) status matrix from history columns given as
+    (build_number, statuses) pairs, oldest build first. Tests added after
+    a build are missing from its (shorter) column."""
+    statuses = numpy.zeros((len(identities), len(columns)), dtype=numpy.uint8)
+    for j, (_, column) in enumerate(columns):
+        column = numpy.frombuffer(column, dtype=numpy.uint8)
+        statuses[:len(column), j] = column[:len(identities)]
+    test_names = [None] * len(identities)
+    for name, index in identities.items():
+        test_names[index] = name
+    return test_names, [x[0] for x in columns], statuses
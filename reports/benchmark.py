@@ -0,0 +1,273 @@
+"""A fake Jenkins, CircleCI and manager logs server serving synthetic or
+recorded payloads with injected latency, used by the benchmark command."""
+
+import collections
+import json
+import math
+import random
+import re
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+
+FOLDER_NAME = 'benchmark'
+JOB_NAME_FORMAT = 'system-tests-{}'
+CIRCLECI_PROJECT_FORMAT = 'benchmark/project-{}'
+
+_NAME_REGEX = re.compile(r'\w+')
+_RANGE_REGEX = re.compile(r'\{(\d+),(\d+)\}')
+
+
+def parse_tree(tree):
+    """Parse a Jenkins tree parameter, e.g. 'a,b[c,d]{0,1}', to a list of
+    (name, sub tree or None, range or None) tuples."""
+    return _parse_fields(tree, 0)[0]
+
+
+def _parse_fields(tree, position):
+    fields = []
+    while position < len(tree) and tree[position] != ']':
+        match = _NAME_REGEX.match(tree, position)
+        name = match.group(0)
+        position = match.end()
+        sub_tree = None
+        value_range = None
+        if position < len(tree) and tree[position] == '[':
+            sub_tree, position = _parse_fields(tree, position + 1)
+            position += 1
+        match = _RANGE_REGEX.match(tree, position)
+        if match:
+            value_range = (int(match.group(1)), int(match.group(2)))
+            position = match.end()
+        fields.append((name, sub_tree, value_range))
+        if position < len(tree) and tree[position] == ',':
+            position += 1
+    return fields, position
+
+
+def apply_tree(data, fields):
+    """Keep only the fields of data listed by a parsed tree, as done by
+    Jenkins."""
+    if isinstance(data, list):
+        return [apply_tree(x, fields) for x in data]
+    if not isinstance(data, dict):
+        return data
+    result = {}
+    for name, sub_tree, value_range in fields:
+        if name not in data:
+            continue
+        value = data[name]
+        if value_range and isinstance(value, list):
+            value = value[value_range[0]:value_range[1]]
+        result[name] = apply_tree(value, sub_tree) if sub_tree else value
+    return result
+
+
+class FakeUpstream(object):
+    """Synthetic Jenkins jobs, builds and test reports plus CircleCI
+    projects. The newest build of every job is in progress and every
+    other build was started by timer. If report is provided (a recorded
+    testReport JSON response), it's served for every completed build.
+    Every response is delayed by latency seconds."""
+
+    def __init__(self, jobs=5, builds=50, suites=10, cases=100,
+                 projects=20, latency=0.05, report=None, seed=0):
+        self.job_names = [JOB_NAME_FORMAT.format(i) for i in range(jobs)]
+        self.projects = [CIRCLECI_PROJECT_FORMAT.format(i)
+                         for i in range(projects)]
+        self.builds_count = builds
+        self.latency = latency
+        self._suites = suites
+        self._cases = cases
+        self._report = report
+        self._seed = seed
+        self._reports = {}
+        self._created_at = int(time.time() * 1000)
+        self._lock = threading.Lock()
+        self.calls = collections.Counter()
+
+    def build(self, job_name, number):
+        building = number == self.builds_count
+        return {
+            'number': number,
+            'result': None if building else (
+                'FAILURE' if number % 5 == 0 else 'SUCCESS'),
+            'building': building,
+            'timestamp': self._created_at -
+            (self.builds_count - number) * 60 * 60 * 1000,
+            'duration': 0 if building else 30 * 60 * 1000,
+            'actions': [{'causes': [{
+                'shortDescription': 'Started by timer' if number % 2 else
+                'Started by user benchmark',
+                'userName': 'benchmark'
+            }]}]
+        }
+
+    def report(self, job_name, number):
+        if self._report is not None:
+            return self._report
+        key = (job_name, number)
+        with self._lock:
+            if key not in self._reports:
+                self._reports[key] = self._generate_report(number)
+            return self._reports[key]
+
+    def _generate_report(self, number):
+        rand = random.Random('{}-{}'.format(self._seed, number))
+        counts = collections.Counter()
+        suites = []
+        for i in range(self._suites):
+            cases = []
+            for j in range(self._cases):
+                status = rand.choice(('PASSED',) * 18 +
+                                     ('FAILED', 'SKIPPED'))
+                counts[status] += 1
+                failed = status == 'FAILED'
+                cases.append({
+                    'name': 'test_{}'.format(j),
+                    'className': 'system_tests.suite_{}.Test{}'.format(
+                            i, j % 10),
+                    'status': status,
+                    'duration': rand.uniform(0.1, 60),
+                    'errorDetails': 'AssertionError' if failed else None,
+                    'errorStackTrace': 'Traceback\n' * 20 if failed else None,
+                    'stdout': 'output line\n' * rand.randint(0, 100),
+                    'stderr': None
+                })
+            suites.append({'name': 'suite_{}'.format(i), 'cases': cases})
+        return {
+            'passCount': counts['PASSED'],
+            'failCount': counts['FAILED'],
+            'skipCount': counts['SKIPPED'],
+            'suites': suites
+        }
+
+    def jenkins_resource(self, path):
+        """Return the call type and JSON of a Jenkins API resource, or
+        (call type, None) if not found."""
+        names = [x for x in path.split('/') if x]
+        if names[-2:] != ['api', 'json']:
+            return 'unknown', None
+        names = names[:-2]
+        if names[:2] != ['job', FOLDER_NAME]:
+            return 'unknown', None
+        if len(names) == 2:
+            return 'folder', {'jobs': [{'name': x, 'displayName': x}
+                                       for x in self.job_names]}
+        job_name = names[3] if names[2:3] == ['job'] else None
+        if job_name not in self.job_names:
+            return 'job', None
+        if len(names) == 4:
+            builds = [self.build(job_name, x)
+                      for x in range(self.builds_count, 0, -1)]
+            return 'job', {'name': job_name,
+                           'displayName': job_name,
+                           'builds': builds,
+                           'allBuilds': builds}
+        if not names[4].isdigit() or \
+                not 0 < int(names[4]) <= self.builds_count:
+            return 'build', None
+        number = int(names[4])
+        if len(names) == 5:
+            return 'build', self.build(job_name, number)
+        if names[5:] == ['testReport'] and number != self.builds_count:
+            return 'testReport', self.report(job_name, number)
+        return 'testReport', None
+
+    def circleci_builds(self, path, limit):
+        match = re.match(r'^/api/v1\.1/project/github/(.+)/tree/\w+$', path)
+        if not match or match.group(1) not in self.projects:
+            return None
+        project = match.group(1)
+        return [{
+            'reponame': project.split('/')[-1],
+            'build_num': number,
+            'status': 'success' if number % 3 else 'failed',
+            'committer_name': 'benchmark',
+            'start_time': '2016-10-01T00:00:00.000Z',
+            'build_time_millis': 5 * 60 * 1000,
+            'build_url': 'http://localhost/{}/{}'.format(project, number)
+        } for number in range(100, 100 - (limit or 30), -1)]
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body, content_type='application/json'):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        upstream = self.server.upstream
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        time.sleep(upstream.latency)
+        if url.path.startswith('/api/'):
+            call = 'circleci'
+            limit = int(query.get('limit', [0])[0])
+            data = upstream.circleci_builds(url.path, limit)
+        elif url.path.endswith('/links.html'):
+            call = 'manager_logs'
+            data = None
+        else:
+            call, data = upstream.jenkins_resource(url.path)
+            call = 'jenkins.{}'.format(call)
+            if data is not None and 'tree' in query:
+                data = apply_tree(data, parse_tree(query['tree'][0]))
+        with upstream._lock:
+            upstream.calls[call] += 1
+        if data is None:
+            self._send(404, 'Not found', content_type='text/plain')
+        else:
+            self._send(200, json.dumps(data))
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeServer(object):
+    """Serves a FakeUpstream on a local port, in a background thread."""
+
+    def __init__(self, upstream, port=0):
+        self.upstream = upstream
+        self._server = _Server(('127.0.0.1', port), _Handler)
+        self._server.upstream = upstream
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='fake-upstream')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def percentile(values, p):
+    """Return the p-th percentile of values (nearest rank)."""
+    values = sorted(values)
+    if not values:
+        return 0
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
@@ -1,26 +1,348 @@
 
+import collections
+import hashlib
 import json
 from functools import wraps
 import logging
+import re
+import threading
+import time
+import uuid
 import zlib
 
-from pymemcache.client.base import Client as MemcachedClient
+from pymemcache.client.base import PooledClient as MemcachedClient
 
+from reports import metrics
+from reports import serialization
 from reports.config import instance as config
 
+# A pooled client is used as builds may be fetched concurrently.
 memcached = MemcachedClient(('localhost', 11211), timeout=1)
 
 _enable_caching = config['enable_caching']
 
+_local_cache_size = config.get('local_cache_size_mb', 64) * 1024 * 1024
+
+# Seconds to wait for a result being fetched by another process, see
+# _wait_for_payload. Disabled (0) by default.
+_lock_timeout = config.get('cache_lock_timeout', 0)
+_LOCK_POLL_INTERVAL = 0.2
+
 
 logger = logging.getLogger('django')
 
+# Keys not matching this (e.g. containing spaces) are hashed, see _safe_key.
+_VALID_KEY_REGEX = re.compile(r'^[\x21-\x7e]{1,200}$')
+
+# Keyword arguments which don't affect results, thus not part of keys.
+_UNCACHED_ARGS = ('timeout', 'offset_hint')
+
+# Marks a cached "not found" result, see cache_result's not_found_error.
+_NOT_FOUND_KEY = '__not_found__'
+
+# Hold results cached with max_stale and the time until they're fresh.
+_VALUE_KEY = '__value__'
+_FRESH_UNTIL_KEY = '__fresh_until__'
+
+# The max_stale of results which may be served while being refreshed.
+DEFAULT_MAX_STALE = config.get('cache_max_stale', 60*60)
+
+# Prefixes the manifest of a value stored in chunks, see _set_payload.
+_CHUNKS_MANIFEST_PREFIX = 'chunks:'
+_MAX_CHUNKS = 32
+
+_stats = collections.Counter()
+_stats_lock = threading.Lock()
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+class _NotFound(object):
+    """A cached "not found" result held by the local cache."""
+
+    def __init__(self, message):
+        self.message = message
+
+
+class _Revalidated(object):
+    """A result held by the local cache which may be served stale, after
+    fresh_until, while being refreshed."""
+
+    def __init__(self, value, fresh_until):
+        self.value = value
+        self.fresh_until = fresh_until
+
+    @property
+    def stale(self):
+        return self.fresh_until <= time.time()
+
+
+class LocalCache(object):
+    """A thread-safe in-process LRU cache holding decoded results.
+    The cache is bounded by the total size of its entries, where an
+    entry's size is the size of its uncompressed encoding."""
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._size = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = collections.Counter()
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._size -= size
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            value, size, expires_at = entry
+            if expires_at and expires_at <= time.time():
+                self._remove(key)
+                self._stats['expired'] += 1
+                self._stats['misses'] += 1
+                return None
+            # Move the entry to the end as the most recently used one.
+            del self._entries[key]
+            self._entries[key] = entry
+            self._stats['hits'] += 1
+            return value
+
+    def set(self, key, value, size, expire=0):
+        if size > self._max_size:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            expires_at = time.time() + expire if expire else 0
+            self._entries[key] = (value, size, expires_at)
+            self._size += size
+            while self._size > self._max_size:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+                self._stats['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update(entries=len(self._entries), size=self._size)
+            return stats
+
+
+# The local cache is disabled (never stores entries) if caching is disabled.
+local_cache = LocalCache(_local_cache_size if _enable_caching else 0)
+
+
+def get_stats():
+    """Return the cache hit/miss counters of this process. The counters of
+    the local cache are under the "local" key."""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['local'] = local_cache.get_stats()
+    return stats
+
+
+def _set_payload(key, payload, expire, chunk_size):
+    """Store a payload in memcached. Payloads larger than chunk_size are
+    split across multiple keys, which are listed by a manifest stored under
+    key. Chunk keys contain a random version so readers never mix chunks of
+    different writes, and the manifest holds a checksum of the payload."""
+    if len(payload) < chunk_size:
+        memcached.set(key, payload, expire=expire)
+        return
+    offsets = range(0, len(payload), chunk_size)
+    if len(offsets) > _MAX_CHUNKS:
+        logger.info('key = "%s" is too large to cache (%d bytes)',
+                    key, len(payload))
+        return
+    version = uuid.uuid4().hex[:8]
+    chunks = collections.OrderedDict(
+            ('{}-chunk-{}-{}'.format(key, version, i),
+             payload[offset:offset + chunk_size])
+            for i, offset in enumerate(offsets))
+    memcached.set_many(chunks, expire=expire)
+    manifest = {
+        'version': version,
+        'chunks': len(chunks),
+        'checksum': zlib.crc32(payload) & 0xffffffff
+    }
+    memcached.set(key,
+                  _CHUNKS_MANIFEST_PREFIX + json.dumps(manifest),
+                  expire=expire)
+    _count('chunked_sets')
+
+
+def _get_payload(key):
+    """Read a payload stored by _set_payload. Returns None if the payload
+    or any of its chunks is missing or if the checksum doesn't match."""
+    payload = memcached.get(key)
+    if not payload or not payload.startswith(_CHUNKS_MANIFEST_PREFIX):
+        return payload
+    manifest = json.loads(payload[len(_CHUNKS_MANIFEST_PREFIX):])
+    chunk_keys = ['{}-chunk-{}-{}'.format(key, manifest['version'], i)
+                  for i in range(manifest['chunks'])]
+    chunks = memcached.get_many(chunk_keys)
+    if len(chunks) != len(chunk_keys):
+        logger.info('key = "%s" has missing chunks', key)
+        return None
+    payload = b''.join(chunks[k] for k in chunk_keys)
+    if zlib.crc32(payload) & 0xffffffff != manifest['checksum']:
+        logger.warning('key = "%s" chunks checksum mismatch', key)
+        return None
+    _count('chunked_hits')
+    return payload
+
+
+def _safe_key(key):
+    """Memcached keys are limited to 250 characters with no whitespace or
+    control characters, so other keys are replaced by their hash."""
+    if _VALID_KEY_REGEX.match(key):
+        return key
+    return 'sha1-{}'.format(hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+
+def _wait_for_payload(key, lock_key):
+    """Wait for the process holding lock_key to store the payload of key.
+    Returns None if the lock is released without storing a payload (e.g.
+    the result wasn't cacheable) or after _lock_timeout seconds."""
+    _count('lock_waits')
+    deadline = time.time() + _lock_timeout
+    while time.time() < deadline:
+        time.sleep(_LOCK_POLL_INTERVAL)
+        payload = _get_payload(key)
+        if payload:
+            return payload
+        if memcached.get(lock_key) is None:
+            # The payload may have been stored right before the release.
+            return _get_payload(key)
+    return None
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Coalesces concurrent calls by key: while a call for a key is in
+    progress, other callers for the same key wait for it and share its
+    result (or exception) rather than making the same call."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            _count('coalesced')
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+_calls = SingleFlight()
+
+# Keys of results being refreshed in the background by this process.
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+def _refresh_in_background(key, refresh):
+    """Call refresh in a background thread unless key is being refreshed
+    already by this process."""
+    with _refreshing_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+
+    def run():
+        try:
+            refresh()
+        except Exception as e:
+            logger.warning('Refreshing key = "%s" failed: %s', key, str(e))
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(key)
+
+    _count('revalidations')
+    thread = threading.Thread(target=run, name='cache-refresh')
+    thread.daemon = True
+    thread.start()
+
+
+def _to_result(result_class, as_dict):
+    if isinstance(as_dict, list):
+        return [result_class(x) for x in as_dict]
+    else:
+        return result_class(as_dict)
+
+
+def _from_local_cache(value):
+    if isinstance(value, _NotFound):
+        return value
+    if isinstance(value, _Revalidated):
+        value = value.value
+    # Lists are copied as callers may sort them.
+    return list(value) if isinstance(value, list) else value
+
 
 def cache_result(result_class,
                  key=None,
                  expire=0,
                  max_result_size=1000000,
+                 not_found_error=None,
+                 not_found_expire=60*60,
+                 max_stale=0,
                  **kw):
+    """Cache the result of a client method in memcached and in the local
+    in-process cache. The local cache holds decoded results which are
+    shared between callers, so these should not be modified.
+
+    Results whose compressed size exceeds max_result_size (memcached's max
+    object size) are stored in chunks of max_result_size.
+
+    If not_found_error is provided, instances of it raised by the method
+    with their permanent attribute set are cached as well (for
+    not_found_expire seconds) and re-raised on subsequent calls.
+
+    Concurrent cache misses for the same key are coalesced into a single
+    call of the method. If cache_lock_timeout is configured, processes
+    also coordinate using a memcached lock key, so only the process holding
+    the lock calls the method while others wait for its cached result.
+
+    If max_stale is provided, results are kept for max_stale seconds after
+    they expire. During this time they're still returned while a background
+    thread refreshes them, so callers don't wait for expired results."""
     def decorator(func):
         @wraps(func)
         def _wrapper(*args, **kwargs):
@@ -30,38 +352,155 @@ def cache_result(result_class,
                 values = [str(x) for x in args[1:]]
                 memcached_key = '{}-{}'.format(result_class.__name__.lower(),
                                                '-'.join(values))
-                if kwargs.get('tree'):
-                    memcached_key += '-tree={}'.format(kwargs['tree'])
+                for name in sorted(kwargs):
+                    value = kwargs[name]
+                    if value and name not in _UNCACHED_ARGS:
+                        if isinstance(value, (list, tuple)):
+                            value = ','.join(value)
+                        memcached_key += '-{}={}'.format(name, value)
+                memcached_key = _safe_key(memcached_key)
+            local_result = local_cache.get(memcached_key)
+            metrics.cache_lookups.inc(
+                    result=result_class.__name__,
+                    tier='local',
+                    outcome='miss' if local_result is None else 'hit')
+            if local_result is not None:
+                if isinstance(local_result, _NotFound):
+                    raise not_found_error(local_result.message,
+                                          permanent=True)
+                if isinstance(local_result, _Revalidated) and \
+                        local_result.stale:
+                    _revalidate(memcached_key, args, kwargs)
+                return _from_local_cache(local_result)
+            if not _enable_caching:
+                return _to_result(result_class, func(*args, **kwargs))
+            return _from_local_cache(_calls.do(
+                    memcached_key, lambda: _load(memcached_key, args, kwargs)))
+
+        def _decode(memcached_key, payload):
+            """Decode a cached payload, which is stored in the local cache
+            as well. Returns the result and the time until it's fresh."""
+            logger.info('key = "%s" found in cache!', memcached_key)
+            started_at = time.time()
+            as_dict, size = serialization.decode(payload)
+            metrics.time_cache_decode(result_class.__name__,
+                                      time.time() - started_at)
+            if isinstance(as_dict, dict) and _NOT_FOUND_KEY in as_dict:
+                _count('negative_hits')
+                local_cache.set(memcached_key,
+                                _NotFound(as_dict[_NOT_FOUND_KEY]),
+                                size,
+                                expire=not_found_expire)
+                raise not_found_error(as_dict[_NOT_FOUND_KEY],
+                                      permanent=True)
+            _count('hits')
+            if max_stale and isinstance(as_dict, dict) and \
+                    _FRESH_UNTIL_KEY in as_dict:
+                fresh_until = as_dict[_FRESH_UNTIL_KEY]
+                result = _to_result(result_class, as_dict[_VALUE_KEY])
+                local_cache.set(
+                        memcached_key,
+                        _Revalidated(result, fresh_until),
+                        size,
+                        expire=max(fresh_until + max_stale - time.time(), 1))
+                return result, fresh_until
+            result = _to_result(result_class, as_dict)
+            local_cache.set(memcached_key, result, size, expire=expire)
+            return result, None
+
+        def _load(memcached_key, args, kwargs):
             logger.info('Reading from cache: key = "%s"', memcached_key)
-            result = memcached.get(memcached_key) if _enable_caching else None
-            if result:
-                logger.info('key = "%s" found in cache!', memcached_key)
-                as_dict = json.loads(zlib.decompress(result))
-            else:
-                logger.info('key = "%s" not found in cache :(', memcached_key)
+            payload = _get_payload(memcached_key)
+            metrics.cache_lookups.inc(result=result_class.__name__,
+                                      tier='memcached',
+                                      outcome='hit' if payload else 'miss')
+            if payload:
+                result, fresh_until = _decode(memcached_key, payload)
+                if fresh_until is not None and fresh_until <= time.time():
+                    _revalidate(memcached_key, args, kwargs)
+                return result
+            logger.info('key = "%s" not found in cache :(', memcached_key)
+            lock_key = 'lock-' + memcached_key
+            locked = _lock_timeout and memcached.add(
+                    lock_key, '1', expire=_lock_timeout, noreply=False)
+            if _lock_timeout and not locked:
+                payload = _wait_for_payload(memcached_key, lock_key)
+                if payload:
+                    return _decode(memcached_key, payload)[0]
+            _count('misses')
+            try:
+                return _fetch(memcached_key, args, kwargs)
+            finally:
+                if locked:
+                    memcached.delete(lock_key)
+
+        def _fetch(memcached_key, args, kwargs, cache_not_found=True):
+            try:
                 as_dict = func(*args, **kwargs)
-                if _enable_caching:
-                    compressed_data = zlib.compress(json.dumps(as_dict))
-                    cache = len(compressed_data) < max_result_size
-                    if cache:
-                        cache_if = {k.replace('cache_if_', ''): v
-                                    for k, v in kw.items()
-                                    if k.startswith('cache_if')}
-                        cache = True
-                        if cache_if:
-                            for k, v in cache_if.items():
-                                if as_dict[k] != v:
-                                    cache = False
-                                    break
-                        if cache:
-                            memcached.set(
-                                    memcached_key,
-                                    zlib.compress(json.dumps(as_dict)),
-                                    expire=expire)
-            if isinstance(as_dict, list):
-                return [result_class(x) for x in as_dict]
-            else:
-                return result_class(as_dict)
+            except Exception as e:
+                if (cache_not_found and not_found_error and
+                        isinstance(e, not_found_error) and
+                        getattr(e, 'permanent', False)):
+                    _count('negative_sets')
+                    encoded, size = serialization.encode(
+                            {_NOT_FOUND_KEY: str(e)})
+                    local_cache.set(memcached_key,
+                                    _NotFound(str(e)),
+                                    size,
+                                    expire=not_found_expire)
+                    memcached.set(memcached_key,
+                                  encoded,
+                                  expire=not_found_expire)
+                raise
+            result = _to_result(result_class, as_dict)
+            cache_if = {k.replace('cache_if_', ''): v
+                        for k, v in kw.items()
+                        if k.startswith('cache_if')}
+            # Lists are cached only if all of their items match.
+            items = as_dict if isinstance(as_dict, list) else [as_dict]
+            for k, v in cache_if.items():
+                if any(x[k] != v for x in items):
+                    return result
+            if max_stale:
+                fresh_until = time.time() + expire
+                encoded, size = serialization.encode({
+                    _VALUE_KEY: as_dict,
+                    _FRESH_UNTIL_KEY: fresh_until
+                })
+                local_cache.set(memcached_key,
+                                _Revalidated(result, fresh_until),
+                                size,
+                                expire=expire + max_stale)
+                _set_payload(memcached_key,
+                             encoded,
+                             expire + max_stale,
+                             max_result_size)
+                return result
+            encoded, size = serialization.encode(as_dict)
+            local_cache.set(memcached_key, result, size, expire=expire)
+            _set_payload(memcached_key, encoded, expire, max_result_size)
+            return result
+
+        def _revalidate(memcached_key, args, kwargs):
+            """Refresh a stale result in the background. The result may
+            have been refreshed by another process already, otherwise it's
+            fetched by a single process holding a memcached lock key."""
+            def refresh():
+                payload = _get_payload(memcached_key)
+                if payload and (_decode(memcached_key, payload)[1] or 0) > \
+                        time.time():
+                    return
+                lock_key = 'refresh-' + memcached_key
+                if memcached.add(lock_key, '1', expire=max_stale,
+                                 noreply=False):
+                    try:
+                        # Errors don't replace the stale result.
+                        _fetch(memcached_key, args, kwargs,
+                               cache_not_found=False)
+                    finally:
+                        memcached.delete(lock_key)
+
+            _refresh_in_background(memcached_key, refresh)
 
         return _wrapper
 
@@ -5,13 +5,26 @@ import logging
 import requests
 
 from reports import cache
+from reports import metrics
+from reports.concurrency import parallel_map
+from reports.config import instance as config
+from reports.sessions import create_session
 
-CIRCLE_BUILD_URL = 'https://circleci.com/api/v1.1/project/github/{project}/tree/{branch}'  # NOQA
+_config = config.get('circleci', {})
 
+CIRCLE_URL = _config.get('url', 'https://circleci.com').rstrip('/')
+CIRCLE_BUILD_URL = CIRCLE_URL + '/api/v1.1/project/github/{project}/tree/{branch}'  # NOQA
+CIRCLE_PROJECT_URL = CIRCLE_URL + '/gh/{project}'
+
+BUILD_EXPIRE = 60*5
+BUILD_ERROR_EXPIRE = 60
 
 PASSED_STRINGS = ['success', 'fixed']
 FAILED_STRINGS = ['failed']
 
+# Shared by all clients so connections are kept alive between requests.
+_session = create_session()
+
 
 class Build(dict):
 
@@ -22,38 +35,93 @@ class Build(dict):
     def passed(self):
         return self['status'] in PASSED_STRINGS
 
+    @property
+    def failed(self):
+        return self['status'] in FAILED_STRINGS
+
+    @property
+    def error(self):
+        return self.get('error')
+
     @property
     def duration_str(self):
+        if not self.get('build_time_millis'):
+            return ''
         duration = datetime.timedelta(
                 milliseconds=self.get('build_time_millis'))
         return str(duration).split('.')[0]
 
 
+class CircleCIError(IOError):
+    """Raised when the last build of a project cannot be retrieved. Errors
+    are cached for BUILD_ERROR_EXPIRE seconds so failing projects don't
+    delay every request."""
+
+    def __init__(self, *args, **kwargs):
+        self.permanent = kwargs.pop('permanent', True)
+        super(CircleCIError, self).__init__(*args, **kwargs)
+
+
 class CircleCIClient(object):
 
-    def __init__(self):
+    def __init__(self, session=None, max_workers=None, timeout=None):
         super(CircleCIClient, self).__init__()
+        self._session = session or _session
+        self._max_workers = max_workers or _config.get('max_workers', 8)
+        self._timeout = timeout or _config.get('timeout', 10)
         self._logger = logging.getLogger('django')
 
-    def get_build(self, project, branch='master'):
+    def get_build(self, project, branch='master', limit=None):
+        """Get the builds of a project's branch, newest first. Only the
+        summaries of the last limit builds are requested if provided."""
         url = CIRCLE_BUILD_URL.format(project=project, branch=branch)
-        r = requests.get(url, timeout=10)
+        params = {'limit': limit, 'shallow': 'true'} if limit else None
+        with metrics.UpstreamRequest('circleci', 'builds') as request:
+            r = self._session.get(url, params=params, timeout=self._timeout)
+            request.status = r.status_code
+            request.size = r.raw.tell()
         if r.status_code == 200:
             return [Build(x) for x in r.json()]
         raise requests.HTTPError(
                 'HTTP request error [url={}, status_code={}]'.format(
                         url, r.status_code))
 
-    @cache.cache_result(Build, key='circleci', expire=60*5)
+    @cache.cache_result(Build,
+                        expire=BUILD_EXPIRE,
+                        not_found_error=CircleCIError,
+                        not_found_expire=BUILD_ERROR_EXPIRE,
+                        max_stale=cache.DEFAULT_MAX_STALE)
+    def get_last_build(self, project, branch='master'):
+        """Get the last build of a project's branch. Each project is cached
+        separately, including its errors."""
+        try:
+            builds = self.get_build(project, branch=branch, limit=1)
+        except Exception as e:
+            raise CircleCIError(
+                    'Error getting circleci build for project "{}": '
+                    '{}'.format(project, str(e)))
+        if not builds:
+            raise CircleCIError(
+                    'No circleci builds for project "{}"'.format(project))
+        return dict(builds[0])
+
+    def _get_last_build_or_error(self, project, branch):
+        try:
+            return self.get_last_build(project, branch=branch)
+        except Exception as e:
+            self._logger.error(str(e))
+            return Build({
+                'reponame': project.split('/')[-1],
+                'status': 'error',
+                'error': str(e),
+                'build_url': CIRCLE_PROJECT_URL.format(project=project)
+            })
+
     def get_builds(self, projects, branch='master'):
-        result = []
-        for project in projects:
-            try:
-                builds = self.get_build(project, branch=branch)
-                if len(builds) > 0:
-                    result.append(builds[0])
-            except Exception as e:
-                # TODO: errors should be added to the list with a failure entry.
-                self._logger.error('Error getting circleci build for project '
-                                   '"{}": {}'.format(project, str(e)))
-        return result
+        """Get the last build of every project, concurrently. Projects
+        whose build cannot be retrieved are listed with an error status."""
+        return parallel_map(
+                lambda project: self._get_last_build_or_error(project,
+                                                              branch),
+                projects,
+                self._max_workers)
@@ -0,0 +1,134 @@
+import heapq
+
+from reports import cache
+from reports import store
+from reports.jenkins import client as jenkins_client
+
+# A duration change is listed if it's at least this many seconds and this
+# ratio of the base duration.
+DURATION_DELTA_MIN_SECONDS = 10
+DURATION_DELTA_MIN_RATIO = 0.5
+
+# The number of slower (and faster) tests listed.
+MAX_DURATION_CHANGES = 100
+
+
+class ReportDiff(dict):
+    """The differences between the test reports of two builds of a job.
+    Tests are listed as dicts with their suite, class name, name, status
+    and duration in both builds."""
+
+    def __init__(self, data):
+        self.update(data)
+
+    @property
+    def new_failures(self):
+        return self['new_failures']
+
+    @property
+    def fixes(self):
+        return self['fixes']
+
+    @property
+    def new_tests(self):
+        return self['new_tests']
+
+    @property
+    def removed_tests(self):
+        return self['removed_tests']
+
+    @property
+    def slower_tests(self):
+        return self['slower_tests']
+
+    @property
+    def faster_tests(self):
+        return self['faster_tests']
+
+
+def _cases_by_id(report):
+    return {case.id: case for suite in report.suites for case in suite.cases}
+
+
+def _test(suite_name, case, base_case=None):
+    test = {
+        'id': case.id,
+        'suite': suite_name,
+        'className': case.className,
+        'name': case.name,
+        'status': case.status,
+        'duration': case.duration_seconds
+    }
+    if base_case is not None:
+        test.update(base_status=base_case.status,
+                    base_duration=base_case.duration_seconds,
+                    duration_delta=(case.duration_seconds -
+                                    base_case.duration_seconds))
+    return test
+
+
+def diff_reports(base_report, report):
+    """Compare two test reports, joining their cases by case id. Runs in
+    linear time of the number of cases. Tests are listed in the order of
+    report (removed tests in the order of base_report)."""
+    base_cases = _cases_by_id(base_report)
+    new_failures = []
+    fixes = []
+    new_tests = []
+    duration_changes = []
+    for suite in report.suites:
+        for case in suite.cases:
+            base_case = base_cases.get(case.id)
+            if base_case is None:
+                new_tests.append(_test(suite.name, case))
+                continue
+            if case.failed and not base_case.failed:
+                new_failures.append(_test(suite.name, case, base_case))
+            elif case.passed and base_case.failed:
+                fixes.append(_test(suite.name, case, base_case))
+            delta = case.duration_seconds - base_case.duration_seconds
+            if abs(delta) >= max(
+                    DURATION_DELTA_MIN_SECONDS,
+                    base_case.duration_seconds * DURATION_DELTA_MIN_RATIO):
+                duration_changes.append(_test(suite.name, case, base_case))
+    case_ids = set(case.id for suite in report.suites for case in suite.cases)
+    removed_tests = [_test(suite.name, case)
+                     for suite in base_report.suites
+                     for case in suite.cases
+                     if case.id not in case_ids]
+    return {
+        'new_failures': new_failures,
+        'fixes': fixes,
+        'new_tests': new_tests,
+        'removed_tests': removed_tests,
+        'slower_tests': heapq.nlargest(
+                MAX_DURATION_CHANGES,
+                (x for x in duration_changes if x['duration_delta'] > 0),
+                key=lambda x: x['duration_delta']),
+        'faster_tests': heapq.nsmallest(
+                MAX_DURATION_CHANGES,
+                (x for x in duration_changes if x['duration_delta'] < 0),
+                key=lambda x: x['duration_delta'])
+    }
+
+
+class ReportComparer(object):
+
+    @cache.cache_result(result_class=ReportDiff, cache_if_completed=True)
+    def compare(self, full_job_name, base_number, build_number):
+        """Compare the test reports of two builds. Since reports of
+        completed builds never change, their diffs are cached without
+        expiry. Raises JenkinsResourceNotFound if either build has no
+        report."""
+        diff = diff_reports(
+                store.get_tests_report(full_job_name, base_number),
+                store.get_tests_report(full_job_name, build_number))
+        diff['completed'] = not any(
+                jenkins_client.get_build(full_job_name,
+                                         x,
+                                         tree='building')['building']
+                for x in (base_number, build_number))
+        return diff
+
+
+comparer = ReportComparer()
@@ -0,0 +1,54 @@
+
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import time
+
+# Returned by map_with_deadline for calls which did not complete in time.
+PENDING = object()
+
+
+def parallel_map(func, items, max_workers):
+    """Apply func to every item using up to max_workers threads.
+    Results are returned in the same order as items. If any call raises,
+    the first exception is re-raised in the calling thread."""
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        return [func(x) for x in items]
+    pool = ThreadPool(min(max_workers, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+
+
+def map_with_deadline(pool, func, items, timeout):
+    """Apply func to every item on a shared thread pool. Each call gets
+    timeout seconds to complete from the time it starts running, and calls
+    which don't start within timeout seconds (the pool being busy) aren't
+    waited for. Results are returned in the same order as items, with
+    PENDING for calls which did not complete in time. These keep running
+    on the pool in the background."""
+    started_at = {}
+
+    def call(i, item):
+        started_at[i] = time.time()
+        return func(item)
+
+    submitted_at = time.time()
+    async_results = [pool.apply_async(call, (i, x))
+                     for i, x in enumerate(items)]
+    results = []
+    for i, async_result in enumerate(async_results):
+        while True:
+            started = i in started_at
+            deadline = started_at.get(i, submitted_at) + timeout
+            try:
+                results.append(
+                        async_result.get(max(deadline - time.time(), 0)))
+            except multiprocessing.TimeoutError:
+                if not started and i in started_at:
+                    # Started while waiting, wait for its own deadline.
+                    continue
+                results.append(PENDING)
+            break
+    return results
@@ -0,0 +1,172 @@
+
+import array
+import logging
+import threading
+
+from django.db import IntegrityError
+from django.db import transaction
+
+from reports import jenkins
+from reports import models
+
+logger = logging.getLogger('django')
+
+HISTORY_SIZE = 30
+
+STATUS_MISSING = 0
+STATUS_PASSED = 1
+STATUS_FAILED = 2
+STATUS_SKIPPED = 3
+STATUS_OTHER = 4
+
+# Test identities (name -> index) of each job, see _get_identities.
+_identities = {}
+_identities_lock = threading.Lock()
+
+
+def test_name(suite, case):
+    return '{}.{}.{}'.format(suite.name, case.className, case.name)
+
+
+def _status_code(status):
+    if status in jenkins.PASSED_STRINGS:
+        return STATUS_PASSED
+    if status in jenkins.FAILED_STRINGS:
+        return STATUS_FAILED
+    if status == jenkins.SKIPPED_STRING:
+        return STATUS_SKIPPED
+    return STATUS_OTHER
+
+
+def _to_bytes(values):
+    return values.tobytes() if hasattr(values, 'tobytes') \
+        else values.tostring()
+
+
+def _from_bytes(typecode, data):
+    values = array.array(typecode)
+    if hasattr(values, 'frombytes'):
+        values.frombytes(bytes(data))
+    else:
+        values.fromstring(bytes(data))
+    return values
+
+
+def _get_identities(job, reload=False):
+    with _identities_lock:
+        if reload or job.name not in _identities:
+            _identities[job.name] = dict(
+                    models.TestIdentity.objects.filter(
+                            job=job).values_list('name', 'index'))
+        return _identities[job.name]
+
+
+def has_column(full_job_name, build_number):
+    return models.TestHistoryColumn.objects.filter(
+            job__name=full_job_name, number=build_number).exists()
+
+
+def missing_columns(full_job_name, build_numbers):
+    """Return the build numbers which have no stored column."""
+    stored = set(models.TestHistoryColumn.objects.filter(
+            job__name=full_job_name,
+            number__in=build_numbers).values_list('number', flat=True))
+    return [x for x in build_numbers if x not in stored]
+
+
+def append_build(full_job_name, build_number, report):
+    """Append the test results of a completed build to the job's history.
+    Tests are interned to per-job indexes, and the build's statuses and
+    durations are stored as arrays indexed by them."""
+    job, _ = models.Job.objects.get_or_create(name=full_job_name)
+    if has_column(full_job_name, build_number):
+        return
+    identities = _get_identities(job, reload=True)
+    results = []
+    new_identities = []
+    for suite in report.suites:
+        for case in suite.cases:
+            name = test_name(suite, case)
+            if name not in identities:
+                identities[name] = len(identities)
+                new_identities.append(models.TestIdentity(
+                        job=job, index=identities[name], name=name))
+            results.append((identities[name],
+                            _status_code(case.status),
+                            case.duration_seconds))
+    statuses = array.array('B', [STATUS_MISSING] * len(identities))
+    durations = array.array('f', [0] * len(identities))
+    for index, status, duration in results:
+        statuses[index] = status
+        durations[index] = duration
+    try:
+        with transaction.atomic():
+            models.TestIdentity.objects.bulk_create(new_identities)
+            models.TestHistoryColumn.objects.create(
+                    job=job,
+                    number=build_number,
+                    statuses=_to_bytes(statuses),
+                    durations=_to_bytes(durations))
+    except IntegrityError:
+        # Appended concurrently by another request or process.
+        logger.info('Tests history of {}/{} already stored'.format(
+                full_job_name, build_number))
+        _get_identities(job, reload=True)
+
+
+class History(object):
+    """Test results of a set of builds, newest first."""
+
+    def __init__(self, identities, columns):
+        self._identities = identities
+        self._columns = columns
+
+    def get(self, suite, case):
+        """Return the results of a test as a list of dicts with the build
+        number and passed/failed/skipped flags. Builds in which the test
+        did not run are omitted."""
+        index = self._identities.get(test_name(suite, case))
+        if index is None:
+            return []
+        history = []
+        for build_number, statuses in self._columns:
+            status = statuses[index] if index < len(statuses) \
+                else STATUS_MISSING
+            if status != STATUS_MISSING:
+                history.append({
+                    'build_number': build_number,
+                    'passed': status == STATUS_PASSED,
+                    'failed': status == STATUS_FAILED,
+                    'skipped': status == STATUS_SKIPPED
+                })
+        return history
+
+
+def get_columns(full_job_name, build_numbers):
+    """Return the job's test identities (name -> index) and the raw status
+    columns of the given builds as (build number, bytes) pairs, oldest
+    build first."""
+    job = models.Job.objects.filter(name=full_job_name).first()
+    if job is None:
+        return {}, []
+    columns = models.TestHistoryColumn.objects.filter(
+            job=job, number__in=build_numbers).order_by('number')
+    return (_get_identities(job, reload=True),
+            [(x.number, bytes(x.statuses)) for x in columns])
+
+
+def get_history(full_job_name, build_numbers):
+    """Return the History of the given builds. Builds without a stored
+    column are ignored."""
+    job = models.Job.objects.filter(name=full_job_name).first()
+    if job is None:
+        return History({}, [])
+    columns = [(x.number, _from_bytes('B', x.statuses))
+               for x in models.TestHistoryColumn.objects.filter(
+                       job=job, number__in=build_numbers).order_by('-number')]
+    identities = _get_identities(job)
+    # Columns longer than the cached identities contain tests interned by
+    # another process (e.g. sync_builds).
+    if any(len(statuses) > len(identities) for _, statuses in columns):
+        identities = _get_identities(job, reload=True)
+    return History(identities, columns)
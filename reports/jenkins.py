@@ -1,28 +1,67 @@
 
 import datetime
+import decimal
+import hashlib
+import importlib
 import json
 import logging
 import math
+import numbers
 import os
 
-import requests
-
 from django.utils import timezone
 
+try:
+    from ijson.common import ObjectBuilder
+except ImportError:
+    ObjectBuilder = None
+
 from reports.config import instance as config
 from reports import cache
+from reports import metrics
+from reports.sessions import create_session
+
+# Reports are streamed using an ijson backend based on the yajl C library
+# if available. ijson's pure Python backend is much slower than loading
+# whole responses, so it's not used.
+ijson = None
+for _backend in ('yajl2_c', 'yajl2_cffi'):
+    try:
+        ijson = importlib.import_module('ijson.backends.' + _backend)
+        break
+    except (ImportError, OSError):
+        pass
 
 PASSED_STRINGS = ('PASSED', 'FIXED', 'SUCCESS')
 FAILED_STRINGS = ('FAILED', 'REGRESSION', 'FAILURE')
 SKIPPED_STRING = 'SKIPPED'
 
+BUILD_SUMMARY_TREE = 'number,result,timestamp,duration,building,actions[causes[shortDescription,userName]]'  # NOQA
+
+REPORT_NOT_FOUND_EXPIRE = 60*60*24
+
+# Test report fields which are kept when parsing, see parse_report. The
+# output of cases is only kept when retrieving a single case.
+SUITE_FIELDS = ('name', 'cases')
+CASE_FIELDS = ('name', 'className', 'status', 'duration', 'errorDetails',
+               'errorStackTrace')
+TEST_CASE_FIELDS = CASE_FIELDS + ('stdout', 'stderr')
+
 TIMER_USER = 'Nightly'
 SCM_CHANGE = 'SCM Change'
 BUILD_FLOW = 'Build Flow'
 
+CAUSE_TIMER = 'timer'
+CAUSE_SCM = 'scm'
+CAUSE_BUILD_FLOW = 'build-flow'
+CAUSE_USER = 'user'
+CAUSE_TIMER_REBUILD = 'timer-rebuild'
+CAUSE_UNKNOWN = 'unknown'
+
+TIMER_BUILD_CAUSES = (CAUSE_TIMER, CAUSE_SCM, CAUSE_BUILD_FLOW)
+
 
 # TODO: redirect to an error page if jenkins is not accessible.
-# TODO: cache the knowledge of no testReports for builds as otherwise 404 queries are performed with no reason
 # TODO: in builds view, don't show the success rate column if not relevant
 # TODO: consider removing "@" from test names in scheduler implementation.
 # TODO: add a full log link in test view.
@@ -30,11 +69,8 @@ BUILD_FLOW = 'Build Flow'
 # TODO: in index, add spinner for in-progress builds.
 # TODO: circleci private repository.
 # TODO: validate configuration after loading from yaml file
-# TODO: when rebuilding a timer build, the causes contains both timer and the user who triggered the rebuild.
 # TODO: browsing to an in progress build should show the link to view the build log.
-# TODO: builds list pagination.
 # TODO: unit tests start time format.
-# TODO: cache menu items.
 
 
 class _Object(dict):
@@ -55,28 +91,52 @@ class Build(_Object):
         super(Build, self).__init__(data)
 
     @property
-    def started_by(self):
-        actions = self.get('actions', [])
-        for action in actions:
-            causes = action.get('causes', [])
-            for cause in causes:
+    def cause(self):
+        """Return the build's cause category and the name of the user who
+        started it. A timer build which was rebuilt by a user has both a
+        timer and a user cause, and is categorized as a timer rebuild."""
+        category = None
+        user = None
+        for action in self.get('actions', []):
+            for cause in action.get('causes', []):
                 description = cause['shortDescription']
                 if 'Started by timer' in description:
-                    return TIMER_USER
-                if 'Started by build flow' in description:
-                    return BUILD_FLOW
+                    found = CAUSE_TIMER
+                elif 'Started by build flow' in description:
+                    found = CAUSE_BUILD_FLOW
                 elif 'Started by an SCM change' in description:
-                    return SCM_CHANGE
+                    found = CAUSE_SCM
                 elif 'Nightly' in description:
-                    return TIMER_USER
+                    found = CAUSE_TIMER
                 elif 'Started by' in description:
-                    return cause.get('userName', 'Unknown')
+                    found = CAUSE_USER
+                    if user is None:
+                        user = cause.get('userName', 'Unknown')
+                else:
+                    continue
+                if category is None:
+                    category = found
+                elif CAUSE_TIMER in (category, found) and \
+                        CAUSE_USER in (category, found):
+                    category = CAUSE_TIMER_REBUILD
+        return category or CAUSE_UNKNOWN, user
 
+    @property
+    def started_by(self):
+        category, user = self.cause
+        if category == CAUSE_TIMER:
+            return TIMER_USER
+        if category == CAUSE_BUILD_FLOW:
+            return BUILD_FLOW
+        if category == CAUSE_SCM:
+            return SCM_CHANGE
+        if category in (CAUSE_USER, CAUSE_TIMER_REBUILD):
+            return user
         return 'Unknown'
 
     @property
     def is_timer_build(self):
-        return self.started_by in (TIMER_USER, SCM_CHANGE, BUILD_FLOW)
+        return self.cause[0] in TIMER_BUILD_CAUSES
 
     @property
     def duration_str(self):
@@ -104,26 +164,53 @@ class Build(_Object):
         return self['result'] in FAILED_STRINGS
 
 
-class Case(_Object):
-    def __init__(self, data, id):
-        super(Case, self).__init__(data)
-        self._id = id
+class _Record(object):
+    """Base class of compact, __slots__ based representations of Jenkins
+    objects which only keep the fields listed in _fields."""
+    __slots__ = ()
+    _fields = ()
 
-    @property
-    def id(self):
-        return self._id
+    def _load(self, data):
+        for field in self._fields:
+            setattr(self, field, data.get(field))
+
+    def to_dict(self):
+        return {x: getattr(self, x) for x in self._fields
+                if getattr(self, x) is not None}
+
+
+class Case(_Record):
+    """A test case. position is the case's position in its suite in the
+    Jenkins report, used for retrieving single cases."""
+    __slots__ = ('id', 'position', 'name', 'className', 'status',
+                 'duration_seconds', 'errorDetails', 'errorStackTrace',
+                 'stdout', 'stderr')
+    _fields = ('name', 'className', 'status', 'errorDetails',
+               'errorStackTrace', 'stdout', 'stderr')
+
+    def __init__(self, data, id, position):
+        self._load(data)
+        self.id = id
+        self.position = data.get('position', position)
+        self.duration_seconds = data.get('duration') or 0
+
+    def to_dict(self):
+        result = super(Case, self).to_dict()
+        result['duration'] = self.duration_seconds
+        result['position'] = self.position
+        return result
 
     @property
     def passed(self):
-        return self['status'] in PASSED_STRINGS
+        return self.status in PASSED_STRINGS
 
     @property
     def failed(self):
-        return self['status'] in FAILED_STRINGS
+        return self.status in FAILED_STRINGS
 
     @property
     def skipped(self):
-        return self['status'] == SKIPPED_STRING
+        return self.status == SKIPPED_STRING
 
     @property
     def duration_str(self):
@@ -131,46 +218,50 @@ class Case(_Object):
 
     @property
     def duration(self):
-        return datetime.timedelta(seconds=self.get('duration'))
+        return datetime.timedelta(seconds=self.duration_seconds)
 
     @property
     def short_class_name(self):
-        return self['className'].split('.')[-1]
+        return self.className.split('.')[-1]
 
 
-class Suite(_Object):
-    def __init__(self, data):
-        super(Suite, self).__init__(data)
-        filtered_cases = self._filter_duplicate_cases(self.get('cases', []))
-        self['cases'] = [
-            Case(x, i) for i, x in enumerate(filtered_cases)]
-        # TODO: cases matching should be done based on test name
+class Suite(_Record):
+    """A test suite. Its counts and total duration are computed once in a
+    single pass over the cases."""
+    __slots__ = ('name', 'cases', 'passed_count', 'failed_count',
+                 'skipped_count', 'total_duration')
+    _fields = ('name',)
 
-    @property
-    def passed_count(self):
-        return len([x for x in self['cases'] if x['status'] in PASSED_STRINGS])
-
-    @property
-    def failed_count(self):
-        return len([x for x in self['cases'] if x['status'] in FAILED_STRINGS])
-
-    @property
-    def skipped_count(self):
-        return len([x for x in self['cases'] if x['status'] == SKIPPED_STRING])
+    def __init__(self, data):
+        self._load(data)
+        filtered_cases = self._filter_duplicate_cases(data.get('cases', []))
+        self.cases = [Case(x,
+                           case_id(self.name, x['className'], x['name']),
+                           position)
+                      for position, x in filtered_cases]
+        passed = failed = skipped = 0
+        total_seconds = 0
+        for case in self.cases:
+            if case.status in PASSED_STRINGS:
+                passed += 1
+            elif case.status in FAILED_STRINGS:
+                failed += 1
+            elif case.status == SKIPPED_STRING:
+                skipped += 1
+            total_seconds += case.duration_seconds
+        self.passed_count = passed
+        self.failed_count = failed
+        self.skipped_count = skipped
+        self.total_duration = datetime.timedelta(seconds=total_seconds)
+
+    def to_dict(self):
+        result = super(Suite, self).to_dict()
+        result['cases'] = [x.to_dict() for x in self.cases]
+        return result
 
     @property
     def total_count(self):
-        return len(self['cases'])
-
-    @property
-    def total_duration(self):
-        total = None
-        for c in self['cases']:
-            if total is None:
-                total = c.duration
-            else:
-                total += c.duration
-        return total
+        return len(self.cases)
 
     @property
     def total_duration_str(self):
@@ -180,38 +271,65 @@ class Suite(_Object):
     def _filter_duplicate_cases(cases):
         """This may occur when a test fails in test code or setup/teardown etc.
         Duplicates cause a confusion so its better to filter and have only
-        one record per test, even if a failure will be missing."""
+        one record per test, even if a failure will be missing.
+        Returns the kept cases with their positions."""
         tests = set()
         no_dups = []
-        for case in cases:
+        for position, case in enumerate(cases):
             test_name = '{}.{}'.format(case['className'], case['name'])
             if test_name not in tests:
-                no_dups.append(case)
+                no_dups.append((position, case))
                 tests.add(test_name)
         return no_dups
 
 
-class Report(_Object):
-    def __init__(self, data):
-        super(Report, self).__init__(data)
-        self['suites'] = [Suite(x) for x in self.get('suites', [])]
-
-    @property
-    def passed_count(self):
-        return self['passCount']
-
-    @property
-    def failed_count(self):
-        return self['failCount']
+class Report(_Record):
+    """A test report. Its suites and cases are indexed by name and id on
+    first lookup, see _get_index."""
+    __slots__ = ('suites', 'passed_count', 'failed_count', 'skipped_count',
+                 '_index')
 
-    @property
-    def skipped_count(self):
-        return self['skipCount']
+    def __init__(self, data):
+        self.suites = [Suite(x) for x in data.get('suites', [])]
+        self.passed_count = data.get('passCount', 0)
+        self.failed_count = data.get('failCount', 0)
+        self.skipped_count = data.get('skipCount', 0)
+        self._index = None
+
+    def to_dict(self):
+        return {
+            'passCount': self.passed_count,
+            'failCount': self.failed_count,
+            'skipCount': self.skipped_count,
+            'suites': [x.to_dict() for x in self.suites]
+        }
 
     @property
     def total_count(self):
         return self.passed_count + self.failed_count + self.skipped_count
 
+    def _get_index(self):
+        """Return the suite names and a dict of case id -> (suite position,
+        case), built once. Reports may be shared by threads, which at worst
+        build the same index concurrently."""
+        index = self._index
+        if index is None:
+            cases = {}
+            for i, suite in enumerate(self.suites):
+                for case in suite.cases:
+                    cases.setdefault(case.id, (i, case))
+            index = self._index = (frozenset(x.name for x in self.suites),
+                                   cases)
+        return index
+
+    def has_suite(self, suite_name):
+        return suite_name in self._get_index()[0]
+
+    def find_case(self, case_id):
+        """Return the suite position and the case of a case id, or
+        (None, None) if not found."""
+        return self._get_index()[1].get(case_id, (None, None))
+
     @property
     def passed_percentage(self):
         return math.trunc(
@@ -223,75 +341,252 @@ class Report(_Object):
                 round((self.failed_count / float(self.total_count)) * 100))
 
 
+def case_id(suite_name, class_name, name):
+    """Return a short hash identifying a test case of a job's reports."""
+    test_name = u'{}.{}.{}'.format(suite_name, class_name, name)
+    return hashlib.sha1(test_name.encode('utf-8')).hexdigest()[:16]
+
+
+def _filter_fields(data, fields):
+    return {k: v for k, v in data.items() if k in fields}
+
+
+def parse_report(stream, case_fields=CASE_FIELDS):
+    """Parse a test report from a response stream, keeping only the report
+    counts, SUITE_FIELDS and case_fields. Using ijson, suites are built one
+    at a time and dropped fields are skipped while parsing, so neither the
+    whole response nor unneeded fields (e.g. stdout) are held in memory.
+    Without an ijson C backend, the response is loaded and filtered."""
+    if ijson is None:
+        data = json.load(stream)
+        report = {k: v for k, v in data.items()
+                  if isinstance(v, numbers.Number)}
+        report['suites'] = [
+            dict(_filter_fields(x, SUITE_FIELDS),
+                 cases=[_filter_fields(c, case_fields)
+                        for c in x.get('cases', [])])
+            for x in data.get('suites', [])]
+        return report
+
+    report = {}
+    suites = []
+    builder = None
+    skipped_prefix = None
+    for prefix, event, value in ijson.parse(stream):
+        if isinstance(value, decimal.Decimal):
+            value = float(value)
+        if builder is None:
+            if prefix == 'suites.item' and event == 'start_map':
+                builder = ObjectBuilder()
+                builder.event(event, value)
+            elif '.' not in prefix and event in ('number', 'boolean'):
+                report[prefix] = value
+            continue
+        if skipped_prefix and (prefix == skipped_prefix or
+                               prefix.startswith(skipped_prefix + '.')):
+            continue
+        skipped_prefix = None
+        if event == 'map_key' and (
+                (prefix == 'suites.item' and value not in SUITE_FIELDS) or
+                (prefix == 'suites.item.cases.item' and
+                 value not in case_fields)):
+            skipped_prefix = '{}.{}'.format(prefix, value)
+            continue
+        builder.event(event, value)
+        if prefix == 'suites.item' and event == 'end_map':
+            suites.append(builder.value)
+            builder = None
+    report['suites'] = suites
+    return report
+
+
+def _resource_type(resource_name):
+    """The type of a Jenkins resource (job, build or testReport), used to
+    label metrics rather than the resource name itself."""
+    last = resource_name.rstrip('/').rsplit('/', 1)[-1]
+    if not last:
+        return 'root'
+    if last.isdigit():
+        return 'build'
+    if last == 'testReport':
+        return 'testReport'
+    return 'job'
+
+
 class JenkinsResourceNotFound(IOError):
 
     def __init__(self, *args, **kwargs):
+        # permanent means the resource will never exist (e.g. the test report
+        # of a completed build without tests) and can be cached as such.
+        self.permanent = kwargs.pop('permanent', False)
         super(JenkinsResourceNotFound, self).__init__(*args, **kwargs)
 
 
 class Client(object):
 
-    def __init__(self, base_url, username=None, password=None):
+    def __init__(self, base_url, username=None, password=None,
+                 timeout=10, session=None):
         self._base_url = base_url
         self._username = username
         self._password = password
+        self._timeout = timeout
+        self._session = session or create_session()
+        self._session.auth = (username, password)
         self._logger = logging.getLogger('django')
 
-    def _query(self, job_name, tree=None, timeout=10):
+    def _query(self, job_name, tree=None, timeout=None, parse=None):
+        """Query a Jenkins resource. If parse is provided, the response is
+        streamed and parse is called with the response stream instead of
+        loading the whole response."""
         resource = '{}{}/api/json{}'.format(
             self._base_url[:-1] if self._base_url.endswith('/') else self._base_url,
             job_name,
             '?tree={}'.format(tree) if tree else '')
 
         self._logger.info('Jenkins query URL: {} [resource={}, tree={}]'.format(resource, job_name, tree))
-        r = requests.get(resource,
-                         auth=(self._username, self._password),
-                         timeout=timeout)
-        if r.status_code == 404:
-            self._logger.warning('Resource not found: {}'.format(resource))
-            raise JenkinsResourceNotFound(
-                    'Jenkins resource not found: {}'.format(resource))
-        if r.status_code != 200:
-            raise RuntimeError('Error on request for: {} [status_code={}]'.format(resource, r.status_code))
-        self._logger.info('Response content length: {}'.format(len(r.content)))
-        result_json = r.json()
-        self._logger.debug('Response for "{}":{}{}'.format(
-                resource,
-                os.linesep,
-                json.dumps(result_json, indent=2)))
+        with metrics.UpstreamRequest('jenkins',
+                                     _resource_type(job_name)) as request:
+            r = self._session.get(resource,
+                                  timeout=timeout or self._timeout,
+                                  stream=parse is not None)
+            request.status = r.status_code
+            try:
+                if r.status_code == 404:
+                    self._logger.warning('Resource not found: {}'.format(resource))
+                    raise JenkinsResourceNotFound(
+                            'Jenkins resource not found: {}'.format(resource))
+                if r.status_code != 200:
+                    raise RuntimeError('Error on request for: {} [status_code={}]'.format(resource, r.status_code))
+                if parse is not None:
+                    r.raw.decode_content = True
+                    result_json = parse(r.raw)
+                else:
+                    self._logger.info('Response content length: {}'.format(len(r.content)))
+                    result_json = r.json()
+                # The size received, before decompression.
+                request.size = r.raw.tell()
+            finally:
+                r.close()
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug('Response for "{}":{}{}'.format(
+                    resource,
+                    os.linesep,
+                    json.dumps(result_json, indent=2)))
         return result_json
 
-    @cache.cache_result(result_class=Job, expire=5*60)
+    @cache.cache_result(result_class=Job,
+                        expire=5*60,
+                        max_stale=cache.DEFAULT_MAX_STALE)
     def get_job(self, job_name='', tree=None):
         """Get job. Since jobs has a builds field and these may change
-        frequently, job responses are cached for 5 minutes."""
+        frequently, job responses are cached for 5 minutes, after which
+        they're refreshed in the background."""
         if job_name:
             job_name = '/job/{}'.format('/job/'.join(job_name.split('/')))
         return self._query(job_name, tree=tree)
 
     @cache.cache_result(result_class=Build, cache_if_building=False)
-    def get_build(self, job_name, build_number, tree=None):
+    def get_build(self, job_name, build_number, tree=None, timeout=None):
         """Get build. Only completed builds are cached as in-progress builds
         whould always be retrieved from jenkins in order to monitor their
         state."""
         resource_name = '/job/{}/{}'.format(
                 '/job/'.join(job_name.split('/')), build_number)
-        return self._query(resource_name, tree=tree)
+        return self._query(resource_name, tree=tree, timeout=timeout)
 
-    @cache.cache_result(result_class=Report)
-    def get_tests_report(self, job_name, build_number, tree=None):
+    @cache.cache_result(result_class=Report,
+                        not_found_error=JenkinsResourceNotFound,
+                        not_found_expire=REPORT_NOT_FOUND_EXPIRE)
+    def get_tests_report(self, job_name, build_number, tree=None,
+                         case_fields=None):
         """Get test report. Since memcached's default max object size is 1mb
-        we use compression and cache only less than 1mb compressed reports."""
+        we use compression and large reports are cached in chunks.
+        A missing report of a completed build is cached as missing.
+        The report is parsed from the response stream, keeping only
+        case_fields (defaults to CASE_FIELDS) of each case."""
+        return self._query_report(job_name, build_number, tree,
+                                  case_fields or CASE_FIELDS)
+
+    def _query_report(self, job_name, build_number, tree, case_fields):
         resource_name = '/job/{}/{}/testReport'.format(
                 '/job/'.join(job_name.split('/')), build_number)
-        return self._query(resource_name, tree=tree)
+        try:
+            return self._query(
+                    resource_name,
+                    tree=tree,
+                    parse=lambda stream: parse_report(stream, case_fields))
+        except JenkinsResourceNotFound as e:
+            build = self.get_build(job_name, build_number, tree='building')
+            e.permanent = not build['building']
+            raise
+
+    @cache.cache_result(result_class=Report)
+    def get_test_case(self, job_name, build_number, suite_position,
+                      case_position):
+        """Get a report containing a single case, at the given positions of
+        the Jenkins report (see Report.find_case)."""
+        tree = 'suites[name,cases[{}]{{{},{}}}]{{{},{}}}'.format(
+                ','.join(TEST_CASE_FIELDS),
+                case_position, case_position + 1,
+                suite_position, suite_position + 1)
+        return self._query_report(job_name, build_number, tree,
+                                  TEST_CASE_FIELDS)
+
+    def list_jobs(self, folder_name, timeout=None):
+        """List the name and display name of the jobs in a folder using a
+        single request. The result is never cached."""
+        resource_name = '/job/{}'.format('/job/'.join(folder_name.split('/')))
+        result = self._query(resource_name,
+                             tree='jobs[name,displayName]',
+                             timeout=timeout)
+        return [Job(x) for x in result.get('jobs', [])]
+
+    def list_builds(self, job_name, start=0, size=25, timeout=None):
+        """List build summaries of a job, newest first, using a single
+        request. start is the offset from the newest build. Since the list
+        may contain in-progress builds, it is never cached."""
+        resource_name = '/job/{}'.format('/job/'.join(job_name.split('/')))
+        tree = 'allBuilds[{}]{{{},{}}}'.format(
+                BUILD_SUMMARY_TREE, start, start + size)
+        result = self._query(resource_name, tree=tree, timeout=timeout)
+        return [Build(x) for x in result.get('allBuilds', [])]
 
-    def get_builds(self, job_name, last_build_number, size=25, tree=None):
-        builds = [self.get_build(job_name, build_number, tree=tree)
-                  for build_number in
-                  range(max(last_build_number - size, 1), last_build_number + 1)]
-        builds.reverse()
-        return builds
+    @cache.cache_result(result_class=Build, cache_if_building=False)
+    def list_builds_page(self, job_name, first_number, size,
+                         offset_hint=0, timeout=None):
+        """List the summaries of a job's builds numbered first_number down
+        to first_number - size + 1, newest first, using a single request
+        of the builds starting at offset_hint (the number of builds newer
+        than first_number, if known). Builds are numbered consecutively,
+        except for deleted builds, so pages of completed builds never
+        change and are cached without expiry."""
+        last_number = first_number - size + 1
+
+        def covers(builds, start, count):
+            # The range covers the page if it starts before the page's
+            # first build (or at the newest build) and ends at or after its
+            # last build (or at the oldest build).
+            return ((start == 0 or builds and
+                     builds[0]['number'] > first_number) and
+                    (len(builds) < count or
+                     builds[-1]['number'] <= last_number))
+
+        start = max(offset_hint - 1, 0)
+        count = size + 1
+        builds = self.list_builds(job_name, start=start, size=count,
+                                  timeout=timeout)
+        if not covers(builds, start, count):
+            # New or deleted builds shifted the offsets, so the range is
+            # extended up to the newest build, and then doubled until it
+            # covers the page, since incomplete pages would be cached.
+            count = offset_hint + 2 * size
+            builds = self.list_builds(job_name, size=count, timeout=timeout)
+            while not covers(builds, 0, count):
+                count *= 2
+                builds = self.list_builds(job_name, size=count,
+                                          timeout=timeout)
+        return [b for b in builds
+                if last_number <= b['number'] <= first_number]
 
     def get_full_build_log_url(self, job_name, build_number):
         resource_name = '{}/job/{}/{}/consoleFull'.format(
@@ -303,4 +598,5 @@ class Client(object):
 
 client = Client(config['jenkins']['url'],
                 config['jenkins']['username'],
-                config['jenkins']['password'])
+                config['jenkins']['password'],
+                timeout=config['jenkins'].get('timeout', 10))
@@ -0,0 +1,189 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import setup_test_environment
+from django.test.utils import teardown_test_environment
+
+from reports import benchmark
+from reports.config import instance as config
+
+# Modules which read the upstream URLs from the configuration on import.
+_CONFIGURED_MODULES = ('reports.jenkins', 'reports.circleci',
+                       'reports.managerlogs')
+
+
+class Command(BaseCommand):
+    help = ('Measure the latency and upstream calls of the dashboard pages '
+            'against a local fake Jenkins/CircleCI server, with cold and '
+            'warm caches. Uses a temporary database, which is emptied '
+            'together with the caches before every cold request (memcached '
+            'is flushed if caching is enabled).')
+    # The checks load the URLs and thus the upstream clients, which must be
+    # created after the configuration points them to the fake server.
+    requires_system_checks = False
+
+    def add_arguments(self, parser):
+        parser.add_argument('--jobs', type=int, default=5)
+        parser.add_argument('--builds', type=int, default=50,
+                            help='Builds per job.')
+        parser.add_argument('--suites', type=int, default=10,
+                            help='Suites per test report.')
+        parser.add_argument('--cases', type=int, default=100,
+                            help='Cases per suite.')
+        parser.add_argument('--projects', type=int, default=20,
+                            help='CircleCI projects.')
+        parser.add_argument('--report',
+                            help='A recorded test report JSON file served '
+                                 'for every build instead of synthetic '
+                                 'reports.')
+        parser.add_argument('--latency', type=int, default=50,
+                            help='Latency of upstream responses in ms.')
+        parser.add_argument('--iterations', type=int, default=10,
+                            help='Requests per page and cache state.')
+        parser.add_argument('--page',
+                            action='append',
+                            dest='pages',
+                            help='Page to benchmark (may be repeated), '
+                                 'defaults to all pages.')
+
+    def _configure(self, server):
+        imported = [x for x in _CONFIGURED_MODULES if x in sys.modules]
+        if imported:
+            raise CommandError('Upstream clients were already created by: '
+                               '{}'.format(', '.join(imported)))
+        upstream = server.upstream
+        config.setdefault('jenkins', {}).update({
+            'url': server.url,
+            'username': 'benchmark',
+            'password': 'benchmark',
+            'job_definitions': [{'name': benchmark.FOLDER_NAME,
+                                 'regex': 'system-tests-.*'}]
+        })
+        config.setdefault('circleci', {}).update({
+            'url': server.url,
+            'projects': upstream.projects
+        })
+        config['manager_logs'] = {'base_url': server.url}
+
+    def _pages(self, upstream):
+        from reports import jenkins
+
+        job_name = upstream.job_names[0]
+        build_number = upstream.builds_count - 1
+        report = upstream.report(job_name, build_number)
+        suite = report['suites'][0]
+        case = suite['cases'][0]
+        case_url = '/job/{}/{}/{}/{}/'.format(
+                job_name, build_number, suite['name'],
+                jenkins.case_id(suite['name'], case['className'],
+                                case['name']))
+        return [
+            ('index', '/'),
+            ('unit_tests', '/ajax/'),
+            ('job', '/job/{}/'.format(job_name)),
+            ('job_builds', '/job/{}/ajax/'.format(job_name)),
+            ('nightly_build', '/job/{}/nightly/ajax/'.format(job_name)),
+            ('job_analytics', '/job/{}/analytics/'.format(job_name)),
+            ('build', '/job/{}/{}/'.format(job_name, build_number)),
+            ('test', case_url),
+            ('manager_logs', case_url + 'manager-logs/'),
+        ]
+
+    def _clear_caches(self):
+        from reports import cache
+        from reports import history
+        from reports import models
+        from reports import store
+
+        cache.local_cache.clear()
+        if cache._enable_caching:
+            cache.memcached.flush_all()
+        models.Job.objects.all().delete()
+        store._cause_index_updated_at.clear()
+        with history._identities_lock:
+            history._identities.clear()
+
+    def _measure(self, client, upstream, url, cold, iterations):
+        latencies = []
+        calls = 0
+        if not cold:
+            client.get(url)
+        for _ in range(iterations):
+            if cold:
+                self._clear_caches()
+            calls_before = sum(upstream.calls.values())
+            started_at = time.time()
+            response = client.get(url)
+            latencies.append(time.time() - started_at)
+            calls += sum(upstream.calls.values()) - calls_before
+            if response.status_code != 200:
+                self.stderr.write('{} responded with {}'.format(
+                        url, response.status_code))
+        return latencies, calls / float(iterations)
+
+    def handle(self, *args, **options):
+        report = None
+        if options['report']:
+            with open(options['report'], 'r') as f:
+                report = json.load(f)
+        upstream = benchmark.FakeUpstream(jobs=options['jobs'],
+                                          builds=options['builds'],
+                                          suites=options['suites'],
+                                          cases=options['cases'],
+                                          projects=options['projects'],
+                                          latency=options['latency'] / 1000.0,
+                                          report=report)
+        server = benchmark.FakeServer(upstream)
+        self._configure(server)
+        server.start()
+        setup_test_environment()
+        # Nightly builds are looked up by other threads, which can't access
+        # an in-memory database.
+        database_dir = tempfile.mkdtemp(prefix='jetere-benchmark-')
+        connection.settings_dict['TEST']['NAME'] = os.path.join(
+                database_dir, 'db.sqlite3')
+        old_database_name = connection.creation.create_test_db(verbosity=0)
+        try:
+            self._run(upstream, options)
+        finally:
+            connection.creation.destroy_test_db(old_database_name,
+                                                verbosity=0)
+            shutil.rmtree(database_dir, ignore_errors=True)
+            teardown_test_environment()
+            server.stop()
+
+    def _run(self, upstream, options):
+        pages = self._pages(upstream)
+        if options['pages']:
+            unknown = set(options['pages']) - set(x for x, _ in pages)
+            if unknown:
+                raise CommandError('Unknown pages: {}'.format(
+                        ', '.join(sorted(unknown))))
+            pages = [x for x in pages if x[0] in options['pages']]
+        iterations = options['iterations']
+        client = Client()
+
+        self.stdout.write('{:<16}{:<6}{:>10}{:>10}{:>10}{:>10}{:>16}'.format(
+                'page', 'cache', 'p50 (ms)', 'p90 (ms)', 'p99 (ms)',
+                'max (ms)', 'upstream calls'))
+        for name, url in pages:
+            for cold in (True, False):
+                latencies, calls = self._measure(client, upstream, url, cold,
+                                                 iterations)
+                self.stdout.write(
+                        '{:<16}{:<6}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}'
+                        '{:>16.1f}'.format(
+                                name,
+                                'cold' if cold else 'warm',
+                                benchmark.percentile(latencies, 50) * 1000,
+                                benchmark.percentile(latencies, 90) * 1000,
+                                benchmark.percentile(latencies, 99) * 1000,
+                                max(latencies) * 1000,
+                                calls))
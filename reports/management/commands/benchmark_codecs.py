@@ -0,0 +1,51 @@
+import json
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from reports import serialization
+
+
+class Command(BaseCommand):
+    help = ('Compare cache codecs and compression levels on recorded test '
+            'reports (JSON responses of a testReport/api/json request).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('reports', nargs='+', help='Report JSON files.')
+        parser.add_argument('--levels',
+                            default='1,6,9',
+                            help='Comma separated zlib compression levels.')
+        parser.add_argument('--iterations', type=int, default=10)
+
+    def handle(self, *args, **options):
+        reports = []
+        for path in options['reports']:
+            with open(path, 'r') as f:
+                reports.append(json.load(f))
+        levels = [int(x) for x in options['levels'].split(',')]
+        iterations = options['iterations']
+
+        self.stdout.write('{:<10}{:>7}{:>14}{:>14}{:>14}'.format(
+                'codec', 'level', 'size (bytes)', 'encode (ms)',
+                'decode (ms)'))
+        for name, codec in sorted(serialization.codecs.items()):
+            for level in levels:
+                size = 0
+                encode_time = 0
+                decode_time = 0
+                for report in reports:
+                    encoded, _ = serialization.encode(
+                            report, codec=codec, compression_level=level)
+                    size += len(encoded)
+                    encode_time += timeit.timeit(
+                            lambda: serialization.encode(
+                                    report,
+                                    codec=codec,
+                                    compression_level=level),
+                            number=iterations) / iterations
+                    decode_time += timeit.timeit(
+                            lambda: serialization.decode(encoded),
+                            number=iterations) / iterations
+                self.stdout.write('{:<10}{:>7}{:>14}{:>14.2f}{:>14.2f}'.format(
+                        name, level, size,
+                        encode_time * 1000, decode_time * 1000))
@@ -0,0 +1,44 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from reports import store
+
+
+class Command(BaseCommand):
+    help = ('Store completed builds and test reports of the configured '
+            'jobs in the database and update their build cause index. '
+            'Only builds newer than the last sync are retrieved.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--job',
+                            action='append',
+                            dest='jobs',
+                            help='Full job name to sync (may be repeated), '
+                                 'defaults to all configured jobs.')
+        parser.add_argument('--max-builds',
+                            type=int,
+                            default=100,
+                            help='Number of builds to store on a job\'s '
+                                 'first sync.')
+        parser.add_argument('--interval',
+                            type=int,
+                            default=0,
+                            help='Keep syncing every given number of '
+                                 'seconds.')
+
+    def handle(self, *args, **options):
+        while True:
+            for job_name in options['jobs'] or store.list_configured_jobs():
+                try:
+                    count = store.sync_job(job_name,
+                                           max_builds=options['max_builds'])
+                    store.update_cause_index(job_name)
+                    self.stdout.write('{}: {} new builds'.format(job_name,
+                                                                 count))
+                except Exception as e:
+                    self.stderr.write('{}: sync failed: {}'.format(job_name,
+                                                                   str(e)))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
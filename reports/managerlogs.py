@@ -0,0 +1,69 @@
+
+import logging
+
+from reports import cache
+from reports import metrics
+from reports.config import instance as config
+from reports.sessions import create_session
+
+DEFAULT_BASE_URL = 'http://cloudify-tests-logs.s3.amazonaws.com'
+
+LOGS_EXPIRE = 60*60*24
+LOGS_NOT_FOUND_EXPIRE = 60*10
+
+_config = config.get('manager_logs', {})
+
+
+class ManagerLogs(dict):
+
+    def __init__(self, data):
+        self.update(data)
+
+    @property
+    def content(self):
+        return self['content']
+
+
+class ManagerLogsNotFound(IOError):
+
+    def __init__(self, *args, **kwargs):
+        self.permanent = kwargs.pop('permanent', False)
+        super(ManagerLogsNotFound, self).__init__(*args, **kwargs)
+
+
+class ManagerLogsClient(object):
+    """Retrieves the links page of the Cloudify manager logs uploaded by a
+    system test. Missing logs are cached for a short time as they may be
+    uploaded while the build is still running."""
+
+    def __init__(self, base_url, timeout=5, session=None):
+        self._base_url = base_url.rstrip('/')
+        self._timeout = timeout
+        self._session = session or create_session()
+        self._logger = logging.getLogger('django')
+
+    @cache.cache_result(result_class=ManagerLogs,
+                        expire=LOGS_EXPIRE,
+                        not_found_error=ManagerLogsNotFound,
+                        not_found_expire=LOGS_NOT_FOUND_EXPIRE)
+    def get_logs(self, build_number, class_name, test_name):
+        url = '{base_url}/{build_number}/{build_number}-{class_name}-{test_name}/links.html'.format(  # NOQA
+                base_url=self._base_url,
+                build_number=build_number,
+                class_name=class_name,
+                test_name=test_name)
+        with metrics.UpstreamRequest('manager_logs', 'links') as request:
+            r = self._session.get(url, timeout=self._timeout)
+            request.status = r.status_code
+            request.size = r.raw.tell()
+        # S3 responds with 403 for missing keys of non listable buckets.
+        if r.status_code in (403, 404):
+            raise ManagerLogsNotFound(
+                    'Manager logs not found: {}'.format(url), permanent=True)
+        if r.status_code != 200:
+            raise RuntimeError('Error on request for: {} [status_code={}]'.format(url, r.status_code))  # NOQA
+        return {'content': r.text}
+
+
+client = ManagerLogsClient(_config.get('base_url', DEFAULT_BASE_URL),
+                           timeout=_config.get('timeout', 5))
@@ -0,0 +1,64 @@
+
+import logging
+import re
+import threading
+import time
+
+from reports import jenkins
+from reports.config import instance as config
+from reports.jenkins import client as jenkins_client
+
+logger = logging.getLogger('django')
+
+
+def list_configured_jobs(job_definitions):
+    """List the jobs matching the job definitions, using a single request
+    per folder."""
+    folders = {}
+    jobs = []
+    for job_def in job_definitions:
+        folder_name = job_def['name']
+        if folder_name not in folders:
+            folders[folder_name] = jenkins_client.list_jobs(folder_name)
+        jobs.extend(x for x in folders[folder_name]
+                    if re.match(job_def['regex'], x['name']))
+    return jobs
+
+
+class Menu(object):
+    """The jobs listed in the navigation menu, matching the configured
+    job definitions. Jobs are refreshed periodically by a background
+    thread, so only the first request of a process waits for them."""
+
+    def __init__(self, job_definitions, refresh_interval):
+        self._job_definitions = job_definitions
+        self._refresh_interval = refresh_interval
+        self._jobs = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        return list_configured_jobs(self._job_definitions)
+
+    def _refresh(self):
+        while True:
+            time.sleep(self._refresh_interval)
+            try:
+                self._jobs = self._load()
+            except Exception as e:
+                logger.warning('Refreshing menu failed: {}'.format(str(e)))
+
+    def get_jobs(self):
+        """Return copies of the menu jobs so callers may modify them."""
+        if self._jobs is None:
+            with self._lock:
+                if self._jobs is None:
+                    self._jobs = self._load()
+                    refresher = threading.Thread(target=self._refresh,
+                                                 name='menu-refresher')
+                    refresher.daemon = True
+                    refresher.start()
+        return [jenkins.Job(x) for x in self._jobs]
+
+
+instance = Menu(config['jenkins']['job_definitions'],
+                config['jenkins'].get('menu_refresh_interval', 5*60))
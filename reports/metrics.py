@@ -0,0 +1,225 @@
+import bisect
+import collections
+import threading
+import time
+
+# Upper bounds (in seconds) of the latency histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Upper bounds (in bytes) of the response size histogram buckets.
+SIZE_BUCKETS = (1024, 10*1024, 100*1024, 1024*1024, 10*1024*1024)
+
+_metrics = collections.OrderedDict()
+_request_timings = threading.local()
+
+
+def _format_labels(label_names, label_values, **extra):
+    labels = list(zip(label_names, label_values)) + sorted(extra.items())
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+            '{}="{}"'.format(k, str(v).replace('\\', r'\\').replace(
+                    '"', r'\"').replace('\n', r'\n'))
+            for k, v in labels))
+
+
+class _Metric(object):
+    """Base class of metrics aggregated in-process. Values are held per
+    combination of label values and rendered in the Prometheus text
+    exposition format."""
+
+    type = None
+
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics[name] = self
+
+    def _label_values(self, labels):
+        return tuple(labels.get(x, '') for x in self.label_names)
+
+    def _samples(self, label_values, value):
+        yield self.name, _format_labels(self.label_names, label_values), value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description),
+                 '# TYPE {} {}'.format(self.name, self.type)]
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            lines.extend('{}{} {}'.format(name, labels, sample)
+                         for name, labels, sample
+                         in self._samples(label_values, value))
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        label_values = self._label_values(labels)
+        with self._lock:
+            self._values[label_values] = \
+                self._values.get(label_values, 0) + amount
+
+
+class Gauge(_Metric):
+
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._label_values(labels)] = value
+
+
+class Histogram(_Metric):
+
+    type = 'histogram'
+
+    def __init__(self, name, description, label_names=(),
+                 buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, description, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        label_values = self._label_values(labels)
+        with self._lock:
+            counts, total = self._values.get(
+                    label_values, ([0] * (len(self.buckets) + 1), 0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[label_values] = (counts, total + value)
+
+    def _samples(self, label_values, value):
+        counts, total = value
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            yield ('{}_bucket'.format(self.name),
+                   _format_labels(self.label_names, label_values, le=bound),
+                   cumulative)
+        labels = _format_labels(self.label_names, label_values)
+        yield '{}_sum'.format(self.name), labels, total
+        yield '{}_count'.format(self.name), labels, cumulative
+
+
+upstream_request_seconds = Histogram(
+        'jetere_upstream_request_seconds',
+        'Latency of requests to upstream services.',
+        ('upstream', 'resource', 'status'))
+upstream_response_bytes = Histogram(
+        'jetere_upstream_response_bytes',
+        'Size of upstream responses as received.',
+        ('upstream', 'resource'),
+        buckets=SIZE_BUCKETS)
+upstream_errors = Counter(
+        'jetere_upstream_errors_total',
+        'Upstream requests which failed without a response.',
+        ('upstream', 'resource'))
+cache_lookups = Counter(
+        'jetere_cache_lookups_total',
+        'Cache lookups by result type, cache tier and outcome.',
+        ('result', 'tier', 'outcome'))
+cache_decode_seconds = Histogram(
+        'jetere_cache_decode_seconds',
+        'Time spent decoding cached results.',
+        ('result',))
+local_cache_entries = Gauge(
+        'jetere_local_cache_entries',
+        'Entries held by the local cache.')
+local_cache_bytes = Gauge(
+        'jetere_local_cache_bytes',
+        'Size of the entries held by the local cache.')
+view_seconds = Histogram(
+        'jetere_view_seconds',
+        'Latency of views, including template rendering.',
+        ('view', 'status'))
+view_upstream_seconds = Histogram(
+        'jetere_view_upstream_seconds',
+        'Time views spent waiting for upstream services (in the request '
+        'thread only).',
+        ('view', 'upstream'))
+
+
+def _add_request_timing(name, seconds):
+    timings = getattr(_request_timings, 'timings', None)
+    if timings is not None:
+        timings[name] += seconds
+
+
+def time_cache_decode(result, seconds):
+    cache_decode_seconds.observe(seconds, result=result)
+    _add_request_timing('cache', seconds)
+
+
+class UpstreamRequest(object):
+    """A context manager timing an upstream request. The status code (and
+    optionally the response size) should be set once received, requests
+    without a status are counted as errors. The time is also added to the
+    timing breakdown of the current request if any, see TimingMiddleware.
+    """
+
+    def __init__(self, upstream, resource):
+        self.upstream = upstream
+        self.resource = resource
+        self.status = None
+        self.size = None
+
+    def __enter__(self):
+        self._started_at = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        elapsed = time.time() - self._started_at
+        _add_request_timing(self.upstream, elapsed)
+        if self.status is None:
+            upstream_errors.inc(upstream=self.upstream,
+                                resource=self.resource)
+            return
+        upstream_request_seconds.observe(elapsed,
+                                         upstream=self.upstream,
+                                         resource=self.resource,
+                                         status=self.status)
+        if self.size is not None:
+            upstream_response_bytes.observe(self.size,
+                                            upstream=self.upstream,
+                                            resource=self.resource)
+
+
+def render():
+    """Render all metrics in the Prometheus text exposition format."""
+    return '\n'.join(x.render() for x in _metrics.values()) + '\n'
+
+
+class TimingMiddleware(object):
+    """Records the latency of every view and the time it spent waiting for
+    upstream services. The breakdown is also returned to the browser in a
+    Server-Timing header."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        _request_timings.timings = collections.Counter()
+        started_at = time.time()
+        try:
+            response = self.get_response(request)
+            elapsed = time.time() - started_at
+            timings = _request_timings.timings
+        finally:
+            _request_timings.timings = None
+        match = getattr(request, 'resolver_match', None)
+        view = match.url_name if match and match.url_name else 'unknown'
+        view_seconds.observe(elapsed, view=view, status=response.status_code)
+        for upstream, seconds in timings.items():
+            view_upstream_seconds.observe(seconds,
+                                          view=view,
+                                          upstream=upstream)
+        response['Server-Timing'] = ', '.join(
+                ['{};dur={:.1f}'.format(k, v * 1000)
+                 for k, v in sorted(timings.items())] +
+                ['total;dur={:.1f}'.format(elapsed * 1000)])
+        return response
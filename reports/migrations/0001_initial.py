@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Configuration',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('jenkins_url', models.CharField(max_length=128)),
+                ('jenkins_username', models.CharField(max_length=32)),
+                ('jenkins_password', models.CharField(max_length=32)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=256, unique=True)),
+                ('last_synced_build', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Build',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.IntegerField()),
+                ('result', models.CharField(max_length=32, null=True)),
+                ('timestamp', models.BigIntegerField()),
+                ('duration', models.BigIntegerField()),
+                ('actions', models.TextField()),
+                ('has_report', models.BooleanField(default=False)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='builds', to='reports.Job')),
+            ],
+            options={
+                'ordering': ['-number'],
+            },
+        ),
+        migrations.CreateModel(
+            name='TestReport',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data', models.BinaryField()),
+                ('build', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='report', to='reports.Build')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='build',
+            unique_together=set([('job', 'number')]),
+        ),
+    ]
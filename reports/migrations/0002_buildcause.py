@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reports', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='last_indexed_build',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='BuildCause',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.IntegerField()),
+                ('category', models.CharField(max_length=16)),
+                ('user', models.CharField(max_length=128, null=True)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='causes', to='reports.Job')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='buildcause',
+            unique_together=set([('job', 'number')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='buildcause',
+            index_together=set([('job', 'category', 'number')]),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reports', '0002_buildcause'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TestIdentity',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.IntegerField()),
+                ('name', models.TextField()),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tests', to='reports.Job')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TestHistoryColumn',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.IntegerField()),
+                ('statuses', models.BinaryField()),
+                ('durations', models.BinaryField()),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='history', to='reports.Job')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='testidentity',
+            unique_together=set([('job', 'index')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='testhistorycolumn',
+            unique_together=set([('job', 'number')]),
+        ),
+    ]
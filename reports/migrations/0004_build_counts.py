@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reports', '0003_testhistory'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='build',
+            name='fail_count',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='build',
+            name='pass_count',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='build',
+            name='skip_count',
+            field=models.IntegerField(null=True),
+        ),
+    ]
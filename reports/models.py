@@ -2,10 +2,84 @@ from __future__ import unicode_literals
 
 from django.db import models
 
-# Create your models here.
-
 
 class Configuration(models.Model):
     jenkins_url = models.CharField(max_length=128)
     jenkins_username = models.CharField(max_length=32)
     jenkins_password = models.CharField(max_length=32)
+
+
+class Job(models.Model):
+    """A Jenkins job whose completed builds are kept in the local store.
+    Builds up to last_synced_build are all stored (if completed) and the
+    causes of builds up to last_indexed_build are indexed."""
+    name = models.CharField(max_length=256, unique=True)
+    last_synced_build = models.IntegerField(default=0)
+    last_indexed_build = models.IntegerField(default=0)
+
+
+class Build(models.Model):
+    """A completed build summary as returned by Client.list_builds. The
+    counts of its test report are null if it has no report (or was stored
+    without them)."""
+    job = models.ForeignKey(Job, related_name='builds',
+                            on_delete=models.CASCADE)
+    number = models.IntegerField()
+    result = models.CharField(max_length=32, null=True)
+    timestamp = models.BigIntegerField()
+    duration = models.BigIntegerField()
+    actions = models.TextField()
+    has_report = models.BooleanField(default=False)
+    pass_count = models.IntegerField(null=True)
+    fail_count = models.IntegerField(null=True)
+    skip_count = models.IntegerField(null=True)
+
+    class Meta:
+        unique_together = ('job', 'number')
+        ordering = ['-number']
+
+
+class TestReport(models.Model):
+    """A build's test report, stored as compressed JSON."""
+    build = models.OneToOneField(Build, related_name='report',
+                                 on_delete=models.CASCADE)
+    data = models.BinaryField()
+
+
+class BuildCause(models.Model):
+    """The cause category of a build (see jenkins.Build.cause), including
+    builds in progress."""
+    job = models.ForeignKey(Job, related_name='causes',
+                            on_delete=models.CASCADE)
+    number = models.IntegerField()
+    category = models.CharField(max_length=16)
+    user = models.CharField(max_length=128, null=True)
+
+    class Meta:
+        unique_together = ('job', 'number')
+        index_together = [('job', 'category', 'number')]
+
+
+class TestIdentity(models.Model):
+    """A test of a job (suite.className.name), interned to an index into
+    the arrays of TestHistoryColumn."""
+    job = models.ForeignKey(Job, related_name='tests',
+                            on_delete=models.CASCADE)
+    index = models.IntegerField()
+    name = models.TextField()
+
+    class Meta:
+        unique_together = ('job', 'index')
+
+
+class TestHistoryColumn(models.Model):
+    """Test results of a completed build. statuses (unsigned bytes) and
+    durations (floats) are arrays indexed by TestIdentity.index."""
+    job = models.ForeignKey(Job, related_name='history',
+                            on_delete=models.CASCADE)
+    number = models.IntegerField()
+    statuses = models.BinaryField()
+    durations = models.BinaryField()
+
+    class Meta:
+        unique_together = ('job', 'number')
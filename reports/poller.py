@@ -0,0 +1,144 @@
+import logging
+import threading
+import time
+
+from reports.concurrency import parallel_map
+from reports import jenkins
+from reports.config import instance as config
+from reports.jenkins import client as jenkins_client
+
+logger = logging.getLogger('django')
+
+
+class _JobState(object):
+
+    __slots__ = ('version', 'builds', 'polled_at', 'watched_at')
+
+    def __init__(self):
+        self.version = 0
+        self.builds = None
+        self.polled_at = 0
+        self.watched_at = time.time()
+
+    @property
+    def building(self):
+        return any(b['building'] for b in self.builds or [])
+
+
+class BuildPoller(object):
+    """Polls the last builds of the jobs viewed by clients using a single
+    background thread, so the number of Jenkins requests depends on the
+    number of viewed jobs rather than the number of viewers.
+
+    Jobs with builds in progress are polled every interval seconds and
+    other jobs every idle_interval seconds. A job is no longer polled once
+    it wasn't viewed for watch_timeout seconds. Clients use the version
+    returned with the builds in order to wait for changes.
+
+    A waiting client holds a server thread (or a sync worker process) for
+    the whole wait, so at most max_waiters clients wait at a time."""
+
+    def __init__(self, size, interval, idle_interval, watch_timeout,
+                 max_workers, max_waiters):
+        self._size = size
+        self._interval = interval
+        self._idle_interval = idle_interval
+        self._watch_timeout = watch_timeout
+        self._max_workers = max_workers
+        self._max_waiters = max_waiters
+        self._waiters = 0
+        self._jobs = {}
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def _list_builds(self, full_job_name):
+        return jenkins_client.list_builds(full_job_name, size=self._size)
+
+    def _update(self, full_job_name, builds):
+        with self._condition:
+            state = self._jobs.get(full_job_name)
+            if state is None:
+                return
+            state.polled_at = time.time()
+            if builds != state.builds:
+                state.builds = builds
+                state.version += 1
+                self._condition.notify_all()
+
+    def _poll(self, full_job_name):
+        try:
+            self._update(full_job_name, self._list_builds(full_job_name))
+        except Exception as e:
+            logger.warning('Polling builds of "{}" failed: {}'.format(
+                    full_job_name, str(e)))
+
+    def _due_jobs(self):
+        now = time.time()
+        with self._condition:
+            for full_job_name, state in list(self._jobs.items()):
+                if now - state.watched_at > self._watch_timeout:
+                    del self._jobs[full_job_name]
+            return [full_job_name
+                    for full_job_name, state in self._jobs.items()
+                    if now - state.polled_at >= (self._interval
+                                                 if state.building
+                                                 else self._idle_interval)]
+
+    def _run(self):
+        while True:
+            time.sleep(self._interval)
+            try:
+                parallel_map(self._poll, self._due_jobs(), self._max_workers)
+            except Exception as e:
+                logger.warning('Polling builds failed: {}'.format(str(e)))
+
+    def _watch(self, full_job_name):
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='build-poller')
+                self._thread.daemon = True
+                self._thread.start()
+            state = self._jobs.get(full_job_name)
+            if state is None:
+                state = self._jobs[full_job_name] = _JobState()
+            state.watched_at = time.time()
+            return state
+
+    def get_builds(self, full_job_name, version=None, timeout=0):
+        """Return the version and last builds of a job. If version is the
+        current version, wait up to timeout seconds for it to change,
+        unless max_waiters clients are waiting already, in which case the
+        returned version is None so the client doesn't wait again.
+        The builds are copies, which callers may modify.
+        The first call for a job polls it in the calling thread.
+        Raises the polling error if the job was never polled successfully.
+        """
+        state = self._watch(full_job_name)
+        if state.builds is None:
+            self._update(full_job_name, self._list_builds(full_job_name))
+        with self._condition:
+            if state.version == version and timeout > 0:
+                if self._waiters >= self._max_waiters:
+                    return None, [jenkins.Build(b) for b in state.builds]
+                self._waiters += 1
+                try:
+                    deadline = time.time() + timeout
+                    while state.version == version:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            break
+                        self._condition.wait(remaining)
+                finally:
+                    self._waiters -= 1
+            return state.version, [jenkins.Build(b) for b in state.builds]
+
+
+# Polls as many builds as are listed by the job page (DEFAULT_MAX_BUILDS).
+instance = BuildPoller(
+        size=20,
+        interval=config['jenkins'].get('poll_interval', 10),
+        idle_interval=config['jenkins'].get('idle_poll_interval', 60),
+        watch_timeout=config['jenkins'].get('long_poll_timeout', 25) * 2,
+        max_workers=config['jenkins'].get('max_workers', 8),
+        max_waiters=config['jenkins'].get('long_poll_max_waiters', 10))
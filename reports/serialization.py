@@ -0,0 +1,103 @@
+
+import json
+import marshal
+import struct
+import zlib
+
+from reports.config import instance as config
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Encoded values start with a header holding the header version and the
+# id of the codec used, so values written by any codec can be decoded.
+HEADER_VERSION = 1
+_HEADER = struct.Struct('!BB')
+
+
+def _to_plain(value):
+    """Return a copy of value in which instances of dict and list
+    subclasses (e.g. builds) are replaced by plain dicts and lists."""
+    if isinstance(value, dict):
+        return {k: _to_plain(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_plain(x) for x in value]
+    return value
+
+
+class JsonCodec(object):
+    id = 1
+    name = 'json'
+
+    def dumps(self, value):
+        return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(data.decode('utf-8'))
+
+
+class MarshalCodec(object):
+    """Binary encoding of JSON compatible values using marshal. Values are
+    only decodable by the same Python version, which is fine for a cache
+    shared by processes of a single deployment. marshal only supports
+    the exact dict and list types, so values holding instances of their
+    subclasses are converted to plain ones first."""
+    id = 2
+    name = 'marshal'
+
+    def dumps(self, value):
+        try:
+            return marshal.dumps(value, 2)
+        except ValueError:
+            return marshal.dumps(_to_plain(value), 2)
+
+    def loads(self, data):
+        return marshal.loads(data)
+
+
+class MsgpackCodec(object):
+    id = 3
+    name = 'msgpack'
+
+    def dumps(self, value):
+        return msgpack.packb(value, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+codecs = {c.name: c() for c in (JsonCodec, MarshalCodec, MsgpackCodec)
+          if c is not MsgpackCodec or msgpack}
+_codecs_by_id = {c.id: c for c in codecs.values()}
+
+default_codec = codecs[config.get('cache_codec', 'marshal')]
+default_compression_level = config.get('cache_compression_level', 6)
+
+
+def encode(value, codec=None, compression_level=None):
+    """Encode and compress a value. Returns the encoded value and the size
+    of the uncompressed value."""
+    codec = codec or default_codec
+    if compression_level is None:
+        compression_level = default_compression_level
+    data = codec.dumps(value)
+    return (_HEADER.pack(HEADER_VERSION, codec.id) +
+            zlib.compress(data, compression_level),
+            len(data))
+
+
+def decode(encoded):
+    """Decode a value produced by encode. Returns the value and the size of
+    the uncompressed value. Values without a header are treated as
+    compressed JSON, as written before the header was introduced."""
+    if encoded[:1] == b'x':
+        data = zlib.decompress(encoded)
+        return json.loads(data), len(data)
+    version, codec_id = _HEADER.unpack(encoded[:_HEADER.size])
+    if version != HEADER_VERSION or codec_id not in _codecs_by_id:
+        raise ValueError('Unsupported encoding [version={}, codec={}]'.format(
+                version, codec_id))
+    data = zlib.decompress(encoded[_HEADER.size:])
+    return _codecs_by_id[codec_id].loads(data), len(data)
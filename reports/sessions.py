@@ -0,0 +1,32 @@
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from reports.config import instance as config
+
+_http_config = config.get('http', {})
+
+
+def create_session(pool_size=None, retries=None, backoff_factor=None):
+    """Create a keep-alive HTTP session backed by a connection pool.
+    Unspecified arguments are taken from the "http" configuration section.
+    Retries apply to connection errors only: read timeouts aren't retried,
+    so timeouts bound requests, and the callers still see error status
+    codes."""
+    if pool_size is None:
+        pool_size = _http_config.get('pool_size', 10)
+    if retries is None:
+        retries = _http_config.get('retries', 3)
+    if backoff_factor is None:
+        backoff_factor = _http_config.get('backoff_factor', 0.3)
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size,
+                          max_retries=Retry(total=retries,
+                                            read=0,
+                                            backoff_factor=backoff_factor))
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['Accept-Encoding'] = 'gzip'
+    return session
@@ -0,0 +1,290 @@
+
+import json
+import logging
+import time
+import zlib
+
+import requests
+
+from django.db import IntegrityError
+from django.db import transaction
+
+from reports import cache
+from reports import history
+from reports import jenkins
+from reports import menu
+from reports import models
+from reports.config import instance as config
+from reports.jenkins import client as jenkins_client
+
+logger = logging.getLogger('django')
+
+# Stored test reports contain only these fields.
+REPORT_TREE = 'passCount,failCount,skipCount,suites[name,cases[name,className,status,duration]]'  # NOQA
+
+# Only the counts of stored reports, which are stored on their builds.
+COUNTS_TREE = 'passCount,failCount,skipCount'
+
+# Seconds during which the latest timer builds are taken from the cause
+# index without updating it, see last_timer_builds.
+CAUSE_INDEX_MAX_AGE = 60
+
+# The last time each job's cause index was updated by this process.
+_cause_index_updated_at = {}
+
+
+def list_configured_jobs():
+    """Return the full names of the jobs matching the configured
+    job definitions."""
+    job_names = []
+    for job_def in config['jenkins']['job_definitions']:
+        job_names.extend(
+                '{}/{}'.format(job_def['name'], x['name'])
+                for x in menu.list_configured_jobs([job_def]))
+    return job_names
+
+
+def _store_build(job, build):
+    if models.Build.objects.filter(job=job, number=build['number']).exists():
+        return
+    try:
+        report = jenkins_client.get_tests_report(job.name,
+                                                 build['number'],
+                                                 tree=REPORT_TREE)
+    except jenkins.JenkinsResourceNotFound:
+        report = None
+    counts = {}
+    if report is not None:
+        counts = dict(pass_count=report.passed_count,
+                      fail_count=report.failed_count,
+                      skip_count=report.skipped_count)
+    with transaction.atomic():
+        stored_build = models.Build.objects.create(
+                job=job,
+                number=build['number'],
+                result=build.get('result'),
+                timestamp=build['timestamp'],
+                duration=build.get('duration', 0),
+                actions=json.dumps(build.get('actions', [])),
+                has_report=report is not None,
+                **counts)
+        if report is not None:
+            models.TestReport.objects.create(
+                    build=stored_build,
+                    data=zlib.compress(json.dumps(report.to_dict())))
+    history.append_build(job.name, build['number'],
+                         report or jenkins.Report({}))
+
+
+def sync_job(full_job_name, max_builds=100, page_size=25):
+    """Store the completed builds of a job which are newer than its
+    high-water mark, together with their test reports. On the first sync
+    only the last max_builds builds are stored. The high-water mark is
+    advanced up to the oldest build still in progress.
+    Returns the number of builds examined."""
+    job, _ = models.Job.objects.get_or_create(name=full_job_name)
+    new_builds = []
+    start = 0
+    while len(new_builds) < max_builds:
+        builds = jenkins_client.list_builds(full_job_name,
+                                            start=start,
+                                            size=page_size)
+        new = [b for b in builds if b['number'] > job.last_synced_build]
+        new_builds.extend(new)
+        if len(new) < page_size:
+            break
+        start += page_size
+
+    high_water_mark = job.last_synced_build
+    in_progress = False
+    for build in reversed(new_builds[:max_builds]):
+        if build['building']:
+            in_progress = True
+            continue
+        _store_build(job, build)
+        if not in_progress:
+            high_water_mark = build['number']
+    job.last_synced_build = high_water_mark
+    job.save()
+    return len(new_builds)
+
+
+def update_cause_index(full_job_name, max_builds=1000, page_size=100):
+    """Index the causes of the job's builds which are newer than the last
+    indexed build. Causes are known once a build starts, so builds in
+    progress are indexed as well. On the first update only the last
+    max_builds builds are indexed."""
+    job, _ = models.Job.objects.get_or_create(name=full_job_name)
+    new_builds = []
+    start = 0
+    while len(new_builds) < max_builds:
+        builds = jenkins_client.list_builds(full_job_name,
+                                            start=start,
+                                            size=page_size)
+        new = [b for b in builds if b['number'] > job.last_indexed_build]
+        new_builds.extend(new)
+        if len(new) < page_size:
+            break
+        start += page_size
+    _cause_index_updated_at[full_job_name] = time.time()
+    if not new_builds:
+        return
+    causes = []
+    for build in new_builds[:max_builds]:
+        category, user = build.cause
+        causes.append(models.BuildCause(job=job,
+                                        number=build['number'],
+                                        category=category,
+                                        user=user))
+    try:
+        with transaction.atomic():
+            models.BuildCause.objects.bulk_create(causes)
+            models.Job.objects.filter(pk=job.pk).update(
+                    last_indexed_build=new_builds[0]['number'])
+    except IntegrityError:
+        # Indexed concurrently by another request or process.
+        logger.info('Causes of "{}" already indexed'.format(full_job_name))
+
+
+def last_timer_builds(full_job_name, build_number=None, count=5):
+    """Return the numbers of the last count timer builds preceding
+    build_number (or the latest ones if not provided), newest first.
+    The cause index is updated first if it doesn't cover build_number
+    yet, or for the latest builds, if it wasn't updated in the last
+    CAUSE_INDEX_MAX_AGE seconds."""
+    job = models.Job.objects.filter(name=full_job_name).first()
+    if job is None:
+        stale = True
+    elif build_number is None:
+        stale = time.time() - _cause_index_updated_at.get(
+                full_job_name, 0) > CAUSE_INDEX_MAX_AGE
+    else:
+        stale = job.last_indexed_build < build_number
+    if stale:
+        update_cause_index(full_job_name)
+    causes = models.BuildCause.objects.filter(
+            job__name=full_job_name,
+            category__in=jenkins.TIMER_BUILD_CAUSES)
+    if build_number is not None:
+        causes = causes.filter(number__lt=build_number)
+    return list(causes.order_by('-number').values_list(
+            'number', flat=True)[:count])
+
+
+def _to_build(stored_build):
+    return jenkins.Build({
+        'number': stored_build.number,
+        'result': stored_build.result,
+        'timestamp': stored_build.timestamp,
+        'duration': stored_build.duration,
+        'building': False,
+        'actions': json.loads(stored_build.actions)
+    })
+
+
+def list_builds(full_job_name, size=25):
+    """List the last builds of a job, newest first. Builds are listed from
+    Jenkins in order to include new and in-progress builds, but completed
+    builds are taken from the store. If Jenkins cannot be reached, only
+    the stored builds are returned."""
+    stored = list(models.Build.objects.filter(
+            job__name=full_job_name)[:size])
+    try:
+        builds = jenkins_client.list_builds(full_job_name, size=size)
+    except (requests.RequestException, RuntimeError) as e:
+        logger.warning('Listing builds of "{}" failed, using stored builds '
+                       'only: {}'.format(full_job_name, str(e)))
+        return [_to_build(x) for x in stored]
+    stored = {x.number: x for x in stored}
+    return [_to_build(stored[b['number']]) if b['number'] in stored else b
+            for b in builds]
+
+
+def list_builds_page(full_job_name, first_number, size, newest_number):
+    """List the builds of a job numbered first_number down to
+    first_number - size + 1, newest first, using a single range request
+    (see Client.list_builds_page). Completed builds are taken from the
+    store, which is also used if Jenkins cannot be reached."""
+    last_number = max(first_number - size + 1, 1)
+    stored = models.Build.objects.filter(job__name=full_job_name,
+                                         number__gte=last_number,
+                                         number__lte=first_number)
+    try:
+        builds = jenkins_client.list_builds_page(
+                full_job_name,
+                first_number,
+                size,
+                offset_hint=newest_number - first_number)
+    except (requests.RequestException, RuntimeError) as e:
+        logger.warning('Listing builds of "{}" failed, using stored builds '
+                       'only: {}'.format(full_job_name, str(e)))
+        return [_to_build(x) for x in stored]
+    stored = {x.number: x for x in stored}
+    return [_to_build(stored[b['number']]) if b['number'] in stored else b
+            for b in builds]
+
+
+def _load_report(full_job_name, stored_build):
+    """Decode a stored test report. Stored reports don't change, so they're
+    kept decoded in the local cache (and shared by callers)."""
+    key = 'stored-report-{}-{}'.format(full_job_name, stored_build.number)
+    report = cache.local_cache.get(key)
+    if report is None:
+        data = zlib.decompress(bytes(models.TestReport.objects.filter(
+                build=stored_build).values_list('data', flat=True)[0]))
+        report = jenkins.Report(json.loads(data))
+        cache.local_cache.set(key, report, len(data))
+    return report
+
+
+def get_tests_report(full_job_name, build_number, tree=REPORT_TREE):
+    """Get the test report of a build from the store. Reports of builds
+    which are not stored are retrieved from Jenkins using tree, which
+    should not request fields missing from REPORT_TREE. For COUNTS_TREE,
+    only the counts stored on the build are read.
+    Raises JenkinsResourceNotFound if the build has no report."""
+    stored_build = models.Build.objects.filter(
+            job__name=full_job_name,
+            number=build_number).first()
+    if stored_build is None:
+        return jenkins_client.get_tests_report(full_job_name,
+                                               build_number,
+                                               tree=tree)
+    if not stored_build.has_report:
+        raise jenkins.JenkinsResourceNotFound(
+                'No test report for build: {}/{}'.format(full_job_name,
+                                                         build_number),
+                permanent=True)
+    if tree == COUNTS_TREE and stored_build.pass_count is not None:
+        return jenkins.Report({
+            'passCount': stored_build.pass_count,
+            'failCount': stored_build.fail_count,
+            'skipCount': stored_build.skip_count
+        })
+    return _load_report(full_job_name, stored_build)
+
+
+def update_history(full_job_name, build_numbers, max_builds=None):
+    """Append the tests history of the given builds where missing, for up
+    to max_builds of them (in the given order). Builds in progress are
+    skipped, and builds which no longer exist get an empty column."""
+    missing = history.missing_columns(full_job_name, build_numbers)
+    for build_number in missing[:max_builds]:
+        try:
+            build = jenkins_client.get_build(full_job_name,
+                                             build_number,
+                                             tree='building')
+        except jenkins.JenkinsResourceNotFound:
+            logger.info('Build {}/{} not found, its tests history is '
+                        'empty'.format(full_job_name, build_number))
+            history.append_build(full_job_name,
+                                 build_number,
+                                 jenkins.Report({}))
+            continue
+        if build['building']:
+            continue
+        try:
+            report = get_tests_report(full_job_name, build_number)
+        except jenkins.JenkinsResourceNotFound:
+            report = jenkins.Report({})
+        history.append_build(full_job_name, build_number, report)
@@ -10,3 +10,8 @@ register = template.Library()
 @stringfilter
 def pretty_string(value):
     return value.title().replace('-', ' ').replace('_', ' ')
+
+
+@register.filter
+def get_item(dictionary, key):
+    return dictionary.get(key)
@@ -1,3 +1,1187 @@
-# from django.test import TestCase
+import hashlib
+import io
+import json
+from multiprocessing.pool import ThreadPool
+import threading
+import time
 
-# Create your tests here.
+from django import http
+from django.test import RequestFactory
+from django.test import TestCase
+from ijson.backends import python as ijson_python
+
+from reports import ajax
+from reports import analytics
+from reports import benchmark
+from reports import cache
+from reports import circleci
+from reports import compare
+from reports import history
+from reports import jenkins
+from reports import managerlogs
+from reports import metrics
+from reports import models
+from reports import poller
+from reports import serialization
+from reports import store
+from reports import views
+from reports.concurrency import map_with_deadline, PENDING
+
+
+def patch(test, obj, name, value):
+    """Set an attribute of obj, which is restored once test completes."""
+    test.addCleanup(setattr, obj, name, getattr(obj, name))
+    setattr(obj, name, value)
+
+
+class FakeClock(object):
+    """Replaces the time module of the cache, so that time only passes
+    when advanced (sleeping advances it as well)."""
+
+    def __init__(self):
+        self.now = time.time()
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeMemcached(object):
+    """An in-memory replacement of the memcached client. Values expire
+    according to the cache's time module."""
+
+    def __init__(self):
+        self.values = {}
+        self._expires_at = {}
+
+    def _expire(self, key):
+        expires_at = self._expires_at.get(key)
+        if expires_at and expires_at <= cache.time.time():
+            self.delete(key)
+
+    def get(self, key):
+        self._expire(key)
+        return self.values.get(key)
+
+    def get_many(self, keys):
+        for key in keys:
+            self._expire(key)
+        return {k: self.values[k] for k in keys if k in self.values}
+
+    def set(self, key, value, expire=0, noreply=None):
+        self.values[key] = value
+        self._expires_at[key] = cache.time.time() + expire if expire else 0
+        return True
+
+    def set_many(self, values, expire=0, noreply=None):
+        for key, value in values.items():
+            self.set(key, value, expire=expire)
+        return True
+
+    def add(self, key, value, expire=0, noreply=None):
+        if self.get(key) is not None:
+            return False
+        return self.set(key, value, expire=expire)
+
+    def delete(self, key, noreply=None):
+        self.values.pop(key, None)
+        self._expires_at.pop(key, None)
+        return True
+
+
+class CacheTestCase(TestCase):
+    """Runs cache_result against a fake memcached and an empty local
+    cache, with caching enabled."""
+
+    def setUp(self):
+        patch(self, cache, 'memcached', FakeMemcached())
+        patch(self, cache, 'local_cache', cache.LocalCache(10 * 1024 * 1024))
+        patch(self, cache, '_enable_caching', True)
+
+
+def _wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError('Timed out waiting for condition')
+        time.sleep(0.01)
+
+
+def _cached_method(result_class, result, **kwargs):
+    calls = []
+
+    @cache.cache_result(result_class, **kwargs)
+    def get(self, name):
+        calls.append(name)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    return get, calls
+
+
+def _report_data():
+    return {
+        'passCount': 2,
+        'failCount': 1,
+        'skipCount': 1,
+        'suites': [{
+            'name': 'suite',
+            'cases': [
+                {'className': 'a.Test', 'name': 'test_1',
+                 'status': 'PASSED', 'duration': 1.5},
+                {'className': 'a.Test', 'name': 'test_2',
+                 'status': 'FAILED', 'duration': 2,
+                 'errorDetails': 'AssertionError'},
+                {'className': 'a.Test', 'name': 'test_3',
+                 'status': 'SKIPPED', 'duration': 0},
+                {'className': 'b.Test', 'name': 'test_1',
+                 'status': 'PASSED', 'duration': 30}
+            ]
+        }]
+    }
+
+
+def _build_data(number, building=False):
+    return {
+        'number': number,
+        'result': None if building else 'SUCCESS',
+        'building': building,
+        'timestamp': 1475280000000 + number,
+        'duration': 0 if building else 1000,
+        'actions': [{'causes': [{'shortDescription': 'Started by timer'}]}]
+    }
+
+
+# Results of every result_class used with cache_result, as returned by the
+# cached methods. Some hold instances of dict subclasses.
+def _cached_results():
+    return [
+        (jenkins.Job, jenkins.Job({
+            'name': 'job',
+            'builds': [jenkins.Build(_build_data(2)),
+                       jenkins.Build(_build_data(1))]
+        })),
+        (jenkins.Build, jenkins.Build(_build_data(1))),
+        (jenkins.Build, [jenkins.Build(_build_data(2, building=True)),
+                         jenkins.Build(_build_data(1))]),
+        (jenkins.Report, _report_data()),
+        (circleci.Build, circleci.Build({
+            'reponame': 'project',
+            'build_num': 1,
+            'status': 'success',
+            'build_time_millis': 1000
+        })),
+        (managerlogs.ManagerLogs, managerlogs.ManagerLogs(
+                {'content': '<a href="logs.tar.gz">logs</a>'})),
+        (compare.ReportDiff, compare.ReportDiff(dict(
+                compare.diff_reports(jenkins.Report(_report_data()),
+                                     jenkins.Report(_report_data())),
+                completed=True)))
+    ]
+
+
+def _as_data(result):
+    if isinstance(result, list):
+        return [_as_data(x) for x in result]
+    if isinstance(result, jenkins.Report):
+        return result.to_dict()
+    return serialization._to_plain(result)
+
+
+class SerializationTest(TestCase):
+
+    def test_codecs_round_trip(self):
+        value = {
+            'name': u'job',
+            'number': 1,
+            'duration': 1.5,
+            'building': False,
+            'result': None,
+            'builds': [{'number': 1}, {'number': 2}]
+        }
+        for codec in serialization.codecs.values():
+            encoded, size = serialization.encode(value, codec=codec)
+            self.assertEqual((value, size), serialization.decode(encoded))
+
+    def test_codecs_round_trip_dict_subclasses(self):
+        for codec in serialization.codecs.values():
+            for _, result in _cached_results():
+                encoded, _ = serialization.encode(result, codec=codec)
+                self.assertEqual(_as_data(result),
+                                 serialization.decode(encoded)[0])
+
+
+class CacheResultTest(CacheTestCase):
+
+    def test_round_trip_result_classes(self):
+        for codec in serialization.codecs.values():
+            cache.memcached = FakeMemcached()
+            cache.local_cache.clear()
+            patch(self, serialization, 'default_codec', codec)
+            for i, (result_class, result) in enumerate(_cached_results()):
+                name = '{}-{}'.format(codec.name, i)
+                get, calls = _cached_method(result_class, result)
+                fetched = get(None, name)
+                cache.local_cache.clear()
+                decoded = get(None, name)
+                self.assertEqual(1, len(calls))
+                self.assertEqual(_as_data(fetched), _as_data(decoded))
+                for x in (decoded if isinstance(decoded, list)
+                          else [decoded]):
+                    self.assertIsInstance(x, result_class)
+
+    def test_chunked(self):
+        content = ''.join(hashlib.sha1(str(i).encode('utf-8')).hexdigest()
+                          for i in range(100))
+        get, calls = _cached_method(managerlogs.ManagerLogs,
+                                    {'content': content},
+                                    max_result_size=500)
+        get(None, 'logs')
+        self.assertGreater(len(cache.memcached.values), 2)
+        cache.local_cache.clear()
+        self.assertEqual(content, get(None, 'logs').content)
+        self.assertEqual(1, len(calls))
+
+    def test_chunk_missing(self):
+        content = ''.join(hashlib.sha1(str(i).encode('utf-8')).hexdigest()
+                          for i in range(100))
+        get, calls = _cached_method(managerlogs.ManagerLogs,
+                                    {'content': content},
+                                    max_result_size=500)
+        get(None, 'logs')
+        cache.memcached.delete(sorted(x for x in cache.memcached.values
+                                      if '-chunk-' in x)[0])
+        cache.local_cache.clear()
+        self.assertEqual(content, get(None, 'logs').content)
+        self.assertEqual(2, len(calls))
+
+    def test_not_found_cached(self):
+        get, calls = _cached_method(
+                managerlogs.ManagerLogs,
+                managerlogs.ManagerLogsNotFound('Not found', permanent=True),
+                not_found_error=managerlogs.ManagerLogsNotFound)
+        for _ in range(2):
+            with self.assertRaises(managerlogs.ManagerLogsNotFound):
+                get(None, 'logs')
+            cache.local_cache.clear()
+        self.assertEqual(1, len(calls))
+
+    def test_not_found_not_permanent(self):
+        get, calls = _cached_method(
+                managerlogs.ManagerLogs,
+                managerlogs.ManagerLogsNotFound('Not found'),
+                not_found_error=managerlogs.ManagerLogsNotFound)
+        for _ in range(2):
+            with self.assertRaises(managerlogs.ManagerLogsNotFound):
+                get(None, 'logs')
+        self.assertEqual(2, len(calls))
+
+    def test_cache_if(self):
+        get, calls = _cached_method(jenkins.Build,
+                                    [_build_data(2, building=True),
+                                     _build_data(1)],
+                                    cache_if_building=False)
+        get(None, 'builds')
+        get(None, 'builds')
+        self.assertEqual(2, len(calls))
+
+    def test_concurrent_misses_coalesced(self):
+        release = threading.Event()
+        calls = []
+
+        @cache.cache_result(managerlogs.ManagerLogs)
+        def get(self, name):
+            calls.append(name)
+            release.wait(5)
+            raise RuntimeError('Jenkins is down')
+
+        coalesced = cache.get_stats().get('coalesced', 0)
+        pool = ThreadPool(4)
+        self.addCleanup(pool.terminate)
+        results = [pool.apply_async(get, (None, 'logs')) for _ in range(4)]
+        # All calls but the first one wait for it.
+        _wait_until(
+                lambda: cache.get_stats().get('coalesced') == coalesced + 3)
+        release.set()
+        errors = []
+        for result in results:
+            with self.assertRaises(RuntimeError) as e:
+                result.get(5)
+            errors.append(e.exception)
+        self.assertEqual(['logs'], calls)
+        self.assertTrue(all(x is errors[0] for x in errors))
+
+    def _lock_held_by_another_process(self):
+        patch(self, cache, '_lock_timeout', 5)
+        patch(self, cache, '_LOCK_POLL_INTERVAL', 0.01)
+        cache.memcached.set('lock-managerlogs-logs', '1')
+
+    def test_lock_wait_for_payload(self):
+        self._lock_held_by_another_process()
+        get, calls = _cached_method(managerlogs.ManagerLogs,
+                                    {'content': 'fetched'})
+
+        def store_payload():
+            encoded, _ = serialization.encode({'content': 'cached'})
+            cache.memcached.set('managerlogs-logs', encoded)
+            cache.memcached.delete('lock-managerlogs-logs')
+
+        threading.Timer(0.1, store_payload).start()
+        self.assertEqual('cached', get(None, 'logs').content)
+        self.assertEqual([], calls)
+
+    def test_lock_released_without_payload(self):
+        self._lock_held_by_another_process()
+        get, calls = _cached_method(managerlogs.ManagerLogs,
+                                    {'content': 'fetched'})
+        threading.Timer(0.1, cache.memcached.delete,
+                        ('lock-managerlogs-logs',)).start()
+        self.assertEqual('fetched', get(None, 'logs').content)
+        self.assertEqual(['logs'], calls)
+        # The lock of this process is released.
+        self.assertIsNone(cache.memcached.get('lock-managerlogs-logs'))
+
+
+class RevalidationTest(CacheTestCase):
+
+    key = 'managerlogs-logs'
+
+    def setUp(self):
+        super(RevalidationTest, self).setUp()
+        self.clock = FakeClock()
+        patch(self, cache, 'time', self.clock)
+        self.contents = ['first']
+        self.calls = []
+        self.refreshing = threading.Event()
+        self.refreshing.set()
+
+        @cache.cache_result(managerlogs.ManagerLogs, expire=10, max_stale=60)
+        def get(_, name):
+            self.calls.append(name)
+            if len(self.calls) > 1:
+                self.refreshing.wait(5)
+            content = self.contents.pop(0)
+            if isinstance(content, Exception):
+                raise content
+            return {'content': content}
+
+        self.get = get
+        self.assertEqual('first', self.get(None, 'logs').content)
+
+    def _wait_for_refresh(self):
+        def refreshed():
+            with cache._refreshing_lock:
+                return self.key not in cache._refreshing
+        _wait_until(refreshed)
+
+    def test_stale_result_refreshed_once(self):
+        self.contents.append('second')
+        self.refreshing.clear()
+        self.clock.sleep(11)
+        self.assertEqual('first', self.get(None, 'logs').content)
+        _wait_until(lambda: len(self.calls) == 2)
+        # Stale results are returned while being refreshed.
+        self.assertEqual('first', self.get(None, 'logs').content)
+        self.refreshing.set()
+        self._wait_for_refresh()
+        self.assertEqual(2, len(self.calls))
+        self.assertEqual('second', self.get(None, 'logs').content)
+        cache.local_cache.clear()
+        self.assertEqual('second', self.get(None, 'logs').content)
+        self.assertEqual(2, len(self.calls))
+
+    def test_failed_refresh_keeps_stale_result(self):
+        self.contents.append(RuntimeError('Jenkins is down'))
+        self.clock.sleep(11)
+        self.get(None, 'logs')
+        self._wait_for_refresh()
+        self.assertEqual(2, len(self.calls))
+        cache.local_cache.clear()
+        self.contents.append('second')
+        self.refreshing.clear()
+        self.assertEqual('first', self.get(None, 'logs').content)
+        self.refreshing.set()
+        self._wait_for_refresh()
+
+    def test_fetched_after_max_stale(self):
+        self.contents.append('second')
+        self.clock.sleep(71)
+        self.assertEqual('second', self.get(None, 'logs').content)
+        self.assertEqual(2, len(self.calls))
+        with cache._refreshing_lock:
+            self.assertNotIn(self.key, cache._refreshing)
+
+
+class LocalCacheTest(TestCase):
+
+    def test_evictions(self):
+        local_cache = cache.LocalCache(100)
+        local_cache.set('a', 1, 40)
+        local_cache.set('b', 2, 40)
+        self.assertEqual(1, local_cache.get('a'))
+        local_cache.set('c', 3, 40)
+        self.assertEqual(None, local_cache.get('b'))
+        self.assertEqual(1, local_cache.get('a'))
+        self.assertEqual(3, local_cache.get('c'))
+        local_cache.set('d', 4, 101)
+        self.assertEqual(None, local_cache.get('d'))
+        self.assertEqual(1, local_cache.get_stats()['evictions'])
+
+    def test_expiry(self):
+        local_cache = cache.LocalCache(100)
+        local_cache.set('a', 1, 10, expire=0.05)
+        self.assertEqual(1, local_cache.get('a'))
+        time.sleep(0.1)
+        self.assertEqual(None, local_cache.get('a'))
+        self.assertEqual(0, local_cache.get_stats()['size'])
+
+
+class _CircleCIClient(circleci.CircleCIClient):
+
+    def __init__(self, builds):
+        super(_CircleCIClient, self).__init__(session=object())
+        self.builds = builds
+
+    def get_build(self, project, branch='master', limit=None):
+        if isinstance(self.builds, Exception):
+            raise self.builds
+        return [circleci.Build(x) for x in self.builds[:limit]]
+
+
+class CircleCITest(CacheTestCase):
+
+    def test_get_builds_cached(self):
+        client = _CircleCIClient([{'reponame': 'project',
+                                   'build_num': 2,
+                                   'status': 'success'},
+                                  {'reponame': 'project',
+                                   'build_num': 1,
+                                   'status': 'failed'}])
+        for _ in range(2):
+            builds = client.get_builds(['org/project'])
+            self.assertEqual(1, len(builds))
+            self.assertIsInstance(builds[0], circleci.Build)
+            self.assertEqual(2, builds[0]['build_num'])
+            self.assertTrue(builds[0].passed)
+            cache.local_cache.clear()
+
+    def test_get_builds_error(self):
+        client = _CircleCIClient(IOError('Connection refused'))
+        builds = client.get_builds(['org/project'])
+        self.assertEqual('error', builds[0]['status'])
+        self.assertEqual('project', builds[0]['reponame'])
+        self.assertTrue(builds[0].error)
+
+
+class FakeJenkinsClient(object):
+    """Serves builds (newest first) and the test reports of completed
+    builds. Other builds are not found, as if discarded."""
+
+    def __init__(self, builds, reports=None):
+        self.builds = builds
+        self.reports = reports or {}
+        self.calls = []
+
+    def _find(self, build_number):
+        for build in self.builds:
+            if build['number'] == build_number:
+                return build
+        raise jenkins.JenkinsResourceNotFound(
+                'Build not found: {}'.format(build_number))
+
+    def list_builds(self, full_job_name, start=0, size=25):
+        self.calls.append(('list_builds', start, size))
+        return [jenkins.Build(x) for x in self.builds[start:start + size]]
+
+    def get_build(self, full_job_name, build_number, tree=None):
+        self.calls.append(('get_build', build_number))
+        return jenkins.Build(self._find(build_number))
+
+    def get_tests_report(self, full_job_name, build_number, tree=None):
+        self.calls.append(('get_tests_report', build_number))
+        if self._find(build_number)['building'] or \
+                build_number not in self.reports:
+            raise jenkins.JenkinsResourceNotFound(
+                    'No test report: {}'.format(build_number),
+                    permanent=True)
+        return jenkins.Report(self.reports[build_number])
+
+
+class StoreTestCase(TestCase):
+    """Runs the store against a FakeJenkinsClient, set as jenkins."""
+
+    full_job_name = 'dir_system-tests/system-tests'
+
+    def setUp(self):
+        self.jenkins = FakeJenkinsClient([])
+        patch(self, store, 'jenkins_client', self.jenkins)
+        patch(self, store, '_cause_index_updated_at', {})
+        patch(self, cache, 'local_cache', cache.LocalCache(1024 * 1024))
+
+
+class UpdateHistoryTest(StoreTestCase):
+
+    def test_discarded_builds_get_empty_columns(self):
+        self.jenkins.builds = [_build_data(3, building=True),
+                               _build_data(2)]
+        self.jenkins.reports = {2: _report_data()}
+        store.update_history(self.full_job_name, [3, 2, 1])
+        self.assertEqual([3], history.missing_columns(self.full_job_name,
+                                                      [3, 2, 1]))
+        tests_history = history.get_history(self.full_job_name, [3, 2, 1])
+        report = jenkins.Report(_report_data())
+        suite = report.suites[0]
+        self.assertEqual([2], [x['build_number']
+                               for x in tests_history.get(suite,
+                                                          suite.cases[0])])
+
+    def test_max_builds(self):
+        self.jenkins.builds = [_build_data(x) for x in range(10, 0, -1)]
+        self.jenkins.reports = {x: _report_data() for x in range(1, 11)}
+        store.update_history(self.full_job_name, range(10, 0, -1),
+                             max_builds=3)
+        self.assertEqual(list(range(7, 0, -1)), history.missing_columns(
+                self.full_job_name, range(10, 0, -1)))
+
+
+class SyncJobTest(StoreTestCase):
+
+    def _stored_numbers(self):
+        return sorted(models.Build.objects.filter(
+                job__name=self.full_job_name).values_list('number',
+                                                          flat=True))
+
+    def _last_synced_build(self):
+        return models.Job.objects.get(
+                name=self.full_job_name).last_synced_build
+
+    def test_high_water_mark(self):
+        self.jenkins.builds = [_build_data(12, building=True),
+                               _build_data(11),
+                               _build_data(10, building=True)] + \
+            [_build_data(x) for x in range(9, 0, -1)]
+        self.jenkins.reports = {x: _report_data() for x in range(1, 9)}
+        self.assertEqual(12, store.sync_job(self.full_job_name,
+                                            page_size=5))
+        self.assertEqual([1, 2, 3, 4, 5, 6, 7, 8, 9, 11],
+                         self._stored_numbers())
+        self.assertEqual(9, self._last_synced_build())
+        self.assertFalse(models.Build.objects.get(number=9).has_report)
+        self.assertEqual([], history.missing_columns(self.full_job_name,
+                                                     range(1, 10)))
+
+        self.jenkins.builds[0] = _build_data(12)
+        self.jenkins.builds[2] = _build_data(10)
+        self.jenkins.calls = []
+        self.assertEqual(3, store.sync_job(self.full_job_name,
+                                           page_size=5))
+        self.assertEqual(list(range(1, 13)), self._stored_numbers())
+        self.assertEqual(12, self._last_synced_build())
+        self.assertEqual(1, len([x for x in self.jenkins.calls
+                                 if x[0] == 'list_builds']))
+
+    def test_first_sync(self):
+        self.jenkins.builds = [_build_data(x) for x in range(10, 0, -1)]
+        store.sync_job(self.full_job_name, max_builds=3, page_size=2)
+        self.assertEqual([8, 9, 10], self._stored_numbers())
+        self.assertEqual(10, self._last_synced_build())
+
+    def test_stored_builds_listed(self):
+        self.jenkins.builds = [_build_data(2, building=True),
+                               _build_data(1)]
+        self.jenkins.reports = {1: _report_data()}
+        store.sync_job(self.full_job_name)
+        self.assertEqual(jenkins.Report(_report_data()).to_dict(),
+                         store.get_tests_report(self.full_job_name,
+                                                1).to_dict())
+        self.jenkins.calls = []
+        builds = store.list_builds(self.full_job_name, size=2)
+        self.assertEqual([2, 1], [x['number'] for x in builds])
+        self.assertEqual([('list_builds', 0, 2)], self.jenkins.calls)
+
+    def test_stored_report_counts(self):
+        self.jenkins.builds = [_build_data(2), _build_data(1)]
+        self.jenkins.reports = {1: _report_data()}
+        store.sync_job(self.full_job_name)
+        self.jenkins.calls = []
+        with self.assertNumQueries(1):
+            report = store.get_tests_report(self.full_job_name, 1,
+                                            tree=store.COUNTS_TREE)
+        self.assertEqual((2, 1, 1, []),
+                         (report.passed_count, report.failed_count,
+                          report.skipped_count, report.suites))
+        self.assertRaises(jenkins.JenkinsResourceNotFound,
+                          store.get_tests_report, self.full_job_name, 2,
+                          tree=store.COUNTS_TREE)
+        # Full reports are decoded once.
+        report = store.get_tests_report(self.full_job_name, 1)
+        with self.assertNumQueries(1):
+            self.assertIs(report,
+                          store.get_tests_report(self.full_job_name, 1))
+        self.assertEqual([], self.jenkins.calls)
+
+
+class HistoryTest(TestCase):
+
+    full_job_name = 'dir_system-tests/system-tests'
+
+    def _report(self, statuses):
+        return jenkins.Report({'suites': [{
+            'name': 'suite',
+            'cases': [{'className': 'Test', 'name': name, 'status': status}
+                      for name, status in statuses]
+        }]})
+
+    def test_append_build(self):
+        history.append_build(self.full_job_name, 1, self._report(
+                [('a', 'PASSED'), ('b', 'FAILED')]))
+        history.append_build(self.full_job_name, 2, self._report(
+                [('c', 'PASSED'), ('b', 'PASSED'), ('a', 'SKIPPED')]))
+        # Appending a build again has no effect.
+        history.append_build(self.full_job_name, 2, self._report([]))
+        tests_history = history.get_history(self.full_job_name, [3, 2, 1])
+        report = self._report([('a', None), ('b', None), ('c', None)])
+        suite = report.suites[0]
+        self.assertEqual(
+                [{'build_number': 2, 'passed': False, 'failed': False,
+                  'skipped': True},
+                 {'build_number': 1, 'passed': True, 'failed': False,
+                  'skipped': False}],
+                tests_history.get(suite, suite.cases[0]))
+        self.assertEqual([2], [x['build_number'] for x in
+                               tests_history.get(suite, suite.cases[2])])
+
+    def test_identities_interned_by_another_process(self):
+        patch(self, history, '_identities', {})
+        history.append_build(self.full_job_name, 1, self._report(
+                [('a', 'PASSED')]))
+        history.get_history(self.full_job_name, [1])
+        identities = dict(history._identities[self.full_job_name])
+        history.append_build(self.full_job_name, 2, self._report(
+                [('a', 'PASSED'), ('b', 'FAILED')]))
+        # The identities cached by this process don't include b.
+        history._identities[self.full_job_name] = identities
+        tests_history = history.get_history(self.full_job_name, [2, 1])
+        report = self._report([('b', None)])
+        suite = report.suites[0]
+        self.assertEqual([2], [x['build_number'] for x in
+                               tests_history.get(suite, suite.cases[0])])
+
+    def test_status_matrix(self):
+        history.append_build(self.full_job_name, 1, self._report(
+                [('a', 'PASSED'), ('b', 'FAILED')]))
+        history.append_build(self.full_job_name, 2, self._report(
+                [('b', 'FAILED'), ('c', 'FAILED')]))
+        history.append_build(self.full_job_name, 3, self._report(
+                [('a', 'FAILED'), ('b', 'FAILED'), ('c', 'PASSED')]))
+        test_names, build_numbers, statuses = analytics.status_matrix(
+                *history.get_columns(self.full_job_name, [1, 2, 3]))
+        self.assertEqual(['suite.Test.a', 'suite.Test.b', 'suite.Test.c'],
+                         test_names)
+        self.assertEqual([1, 2, 3], build_numbers)
+        self.assertEqual([[history.STATUS_PASSED, history.STATUS_MISSING,
+                           history.STATUS_FAILED],
+                          [history.STATUS_FAILED] * 3,
+                          [history.STATUS_MISSING, history.STATUS_FAILED,
+                           history.STATUS_PASSED]],
+                         statuses.tolist())
+        tests = analytics.TestTrends(
+                test_names, build_numbers, statuses).top()
+        self.assertEqual(['suite.Test.b', 'suite.Test.c', 'suite.Test.a'],
+                         [x['name'] for x in tests])
+        self.assertEqual(3, tests[0]['streak'])
+        self.assertEqual(1, tests[0]['first_failing_build'])
+        self.assertEqual(100, tests[1]['flip_rate'])
+
+
+class DiffReportsTest(TestCase):
+
+    def test_diff_reports(self):
+        data = _report_data()
+        cases = data['suites'][0]['cases']
+        cases[0]['status'] = 'FAILED'
+        cases[1]['status'] = 'PASSED'
+        cases[3]['duration'] = 50
+        del cases[2]
+        cases.append({'className': 'a.Test', 'name': 'test_4',
+                      'status': 'PASSED', 'duration': 1})
+        diff = compare.ReportDiff(compare.diff_reports(
+                jenkins.Report(_report_data()), jenkins.Report(data)))
+
+        def names(tests):
+            return ['{}.{}'.format(x['className'], x['name'])
+                    for x in tests]
+
+        self.assertEqual(['a.Test.test_1'], names(diff.new_failures))
+        self.assertEqual('PASSED', diff.new_failures[0]['base_status'])
+        self.assertEqual(['a.Test.test_2'], names(diff.fixes))
+        self.assertEqual(['a.Test.test_4'], names(diff.new_tests))
+        self.assertEqual(['a.Test.test_3'], names(diff.removed_tests))
+        self.assertEqual(['b.Test.test_1'], names(diff.slower_tests))
+        self.assertEqual(20, diff.slower_tests[0]['duration_delta'])
+        self.assertEqual([], diff.faster_tests)
+
+    def test_same_report(self):
+        report = jenkins.Report(_report_data())
+        diff = compare.diff_reports(report, report)
+        self.assertFalse(any(diff.values()))
+
+
+class _BuildPoller(poller.BuildPoller):
+
+    def __init__(self, builds, max_waiters=10):
+        super(_BuildPoller, self).__init__(size=20,
+                                           interval=3600,
+                                           idle_interval=3600,
+                                           watch_timeout=3600,
+                                           max_workers=1,
+                                           max_waiters=max_waiters)
+        self.builds = builds
+
+    def _list_builds(self, full_job_name):
+        return [jenkins.Build(x) for x in self.builds]
+
+
+class BuildPollerTest(TestCase):
+
+    full_job_name = 'dir_system-tests/system-tests'
+
+    def test_version_changes_with_builds(self):
+        build_poller = _BuildPoller([_build_data(2, building=True),
+                                     _build_data(1)])
+        version, builds = build_poller.get_builds(self.full_job_name)
+        self.assertEqual(1, version)
+        build_poller._poll(self.full_job_name)
+        self.assertEqual(version, build_poller.get_builds(
+                self.full_job_name)[0])
+        build_poller.builds = [_build_data(2), _build_data(1)]
+        build_poller._poll(self.full_job_name)
+        version, builds = build_poller.get_builds(self.full_job_name,
+                                                  version=version,
+                                                  timeout=1)
+        self.assertEqual(2, version)
+        self.assertFalse(builds[0]['building'])
+
+    def test_builds_are_copies(self):
+        build_poller = _BuildPoller([_build_data(1)])
+        version, builds = build_poller.get_builds(self.full_job_name)
+        builds[0]['report'] = jenkins.Report(_report_data())
+        builds.pop()
+        build_poller._poll(self.full_job_name)
+        self.assertEqual((version, [_build_data(1)]),
+                         build_poller.get_builds(self.full_job_name))
+
+    def test_wait_timeout(self):
+        build_poller = _BuildPoller([_build_data(1)])
+        version, _ = build_poller.get_builds(self.full_job_name)
+        self.assertEqual(version, build_poller.get_builds(
+                self.full_job_name, version=version, timeout=0.1)[0])
+
+    def test_max_waiters(self):
+        build_poller = _BuildPoller([_build_data(1)], max_waiters=0)
+        version, builds = build_poller.get_builds(self.full_job_name)
+        self.assertEqual((None, builds), build_poller.get_builds(
+                self.full_job_name, version=version, timeout=10))
+
+
+class ParseReportTest(TestCase):
+
+    def setUp(self):
+        patch(self, jenkins, 'ijson', jenkins.ijson)
+        data = _report_data()
+        data['duration'] = 60.5
+        data['empty'] = False
+        for case in data['suites'][0]['cases']:
+            case.update(stdout='output', stderr=None, age=0)
+        self.response = json.dumps(data).encode('utf-8')
+
+    def _parse(self, backend, case_fields=jenkins.CASE_FIELDS):
+        jenkins.ijson = backend
+        return jenkins.parse_report(io.BytesIO(self.response), case_fields)
+
+    def test_parse_report(self):
+        expected = _report_data()
+        expected.update(duration=60.5, empty=False)
+        self.assertEqual(expected, self._parse(None))
+        self.assertEqual(expected, self._parse(ijson_python))
+
+    def test_parse_report_case_fields(self):
+        for backend in (None, ijson_python):
+            report = self._parse(backend, jenkins.TEST_CASE_FIELDS)
+            self.assertEqual(
+                    set(jenkins.TEST_CASE_FIELDS) - {'errorDetails',
+                                                     'errorStackTrace'},
+                    set(report['suites'][0]['cases'][0]))
+
+
+class LastTimerBuildsTest(StoreTestCase):
+
+    def setUp(self):
+        super(LastTimerBuildsTest, self).setUp()
+        self.jenkins.builds = [_build_data(x) for x in range(10, 0, -1)]
+        for build in self.jenkins.builds[::2]:
+            build['actions'] = [{'causes': [{
+                'shortDescription': 'Started by user admin',
+                'userName': 'admin'}]}]
+
+    def _list_calls(self):
+        return len([x for x in self.jenkins.calls if x[0] == 'list_builds'])
+
+    def test_latest_builds(self):
+        self.assertEqual([9, 7, 5], store.last_timer_builds(
+                self.full_job_name, count=3))
+        self.assertEqual(1, self._list_calls())
+        self.jenkins.builds.insert(0, _build_data(11))
+        self.assertEqual([9, 7, 5], store.last_timer_builds(
+                self.full_job_name, count=3))
+        self.assertEqual(1, self._list_calls())
+        store._cause_index_updated_at[self.full_job_name] -= \
+            store.CAUSE_INDEX_MAX_AGE + 1
+        self.assertEqual([11, 9, 7], store.last_timer_builds(
+                self.full_job_name, count=3))
+        self.assertEqual(2, self._list_calls())
+
+    def test_preceding_builds(self):
+        self.assertEqual([7, 5], store.last_timer_builds(
+                self.full_job_name, build_number=8, count=2))
+        self.assertEqual([3, 1], store.last_timer_builds(
+                self.full_job_name, build_number=5, count=5))
+        self.assertEqual(1, self._list_calls())
+        self.jenkins.builds.insert(0, _build_data(11))
+        self.assertEqual([11, 9], store.last_timer_builds(
+                self.full_job_name, build_number=12, count=2))
+        self.assertEqual(2, self._list_calls())
+
+
+class IntParamTest(TestCase):
+
+    def test_int_param(self):
+        factory = RequestFactory()
+        self.assertEqual(2, views.int_param(factory.get('/?page=2'),
+                                            'page', 1))
+        self.assertEqual(1, views.int_param(factory.get('/'), 'page', 1))
+        self.assertEqual(1, views.int_param(factory.get('/?page=x'),
+                                            'page', 1))
+
+
+class UpstreamJenkinsClient(jenkins.Client):
+    """A Jenkins client querying a benchmark.FakeUpstream rather than a
+    Jenkins server."""
+
+    def __init__(self, upstream):
+        super(UpstreamJenkinsClient, self).__init__('http://localhost/')
+        self.upstream = upstream
+        self.queries = []
+
+    def _query(self, job_name, tree=None, timeout=None, parse=None):
+        self.queries.append(job_name)
+        _, data = self.upstream.jenkins_resource(job_name + '/api/json')
+        if data is None:
+            raise jenkins.JenkinsResourceNotFound(
+                    'Jenkins resource not found: {}'.format(job_name))
+        if tree:
+            data = benchmark.apply_tree(data, benchmark.parse_tree(tree))
+        if parse is not None:
+            return parse(io.BytesIO(json.dumps(data).encode('utf-8')))
+        return data
+
+
+class _PagedJenkinsClient(jenkins.Client):
+    """Lists the builds of a single job, numbered from 1 to newest_number
+    except for deleted ones."""
+
+    def __init__(self, newest_number, deleted=()):
+        super(_PagedJenkinsClient, self).__init__('http://localhost/')
+        self.newest_number = newest_number
+        self.deleted = deleted
+        self.calls = []
+
+    def list_builds(self, job_name, start=0, size=25, timeout=None):
+        self.calls.append((start, size))
+        builds = [_build_data(x) for x in range(self.newest_number, 0, -1)
+                  if x not in self.deleted]
+        return [jenkins.Build(x) for x in builds[start:start + size]]
+
+
+class ListBuildsPageTest(CacheTestCase):
+
+    full_job_name = 'dir_system-tests/system-tests'
+
+    def _list_page(self, client, first_number, offset_hint):
+        return [x['number'] for x in client.list_builds_page(
+                self.full_job_name, first_number, 5,
+                offset_hint=offset_hint)]
+
+    def test_offset_hint(self):
+        client = _PagedJenkinsClient(30)
+        self.assertEqual([20, 19, 18, 17, 16],
+                         self._list_page(client, 20, 10))
+        self.assertEqual([(9, 6)], client.calls)
+
+    def test_new_builds(self):
+        client = _PagedJenkinsClient(32)
+        self.assertEqual([20, 19, 18, 17, 16],
+                         self._list_page(client, 20, 10))
+        self.assertEqual([(9, 6), (0, 20)], client.calls)
+
+    def test_deleted_builds(self):
+        client = _PagedJenkinsClient(30, deleted=(25, 24))
+        self.assertEqual([20, 19, 18, 17, 16],
+                         self._list_page(client, 20, 10))
+        self.assertEqual([(9, 6), (0, 20)], client.calls)
+
+    def test_many_new_builds(self):
+        client = _PagedJenkinsClient(100)
+        self.assertEqual([20, 19, 18, 17, 16],
+                         self._list_page(client, 20, 10))
+        self.assertEqual([(9, 6), (0, 20), (0, 40), (0, 80), (0, 160)],
+                         client.calls)
+        # The complete page is cached.
+        cache.local_cache.clear()
+        self.assertEqual([20, 19, 18, 17, 16],
+                         self._list_page(client, 20, 10))
+        self.assertEqual(5, len(client.calls))
+
+    def test_oldest_builds(self):
+        client = _PagedJenkinsClient(12, deleted=(1,))
+        self.assertEqual([3, 2], self._list_page(client, 3, 9))
+        self.assertEqual([(8, 6)], client.calls)
+
+
+class FakeMenu(object):
+
+    def get_jobs(self):
+        return []
+
+
+class ViewTestCase(CacheTestCase):
+    """Runs views against a benchmark.FakeUpstream with 30 builds, the
+    last of which is in progress. Odd numbered builds are timer builds."""
+
+    job_name = benchmark.JOB_NAME_FORMAT.format(0)
+    full_job_name = '{}/{}'.format(benchmark.FOLDER_NAME, job_name)
+
+    def setUp(self):
+        super(ViewTestCase, self).setUp()
+        self.upstream = benchmark.FakeUpstream(jobs=1, builds=30, suites=2,
+                                               cases=5, latency=0)
+        self.jenkins = UpstreamJenkinsClient(self.upstream)
+        for module in (ajax, compare, poller, store, views):
+            patch(self, module, 'jenkins_client', self.jenkins)
+        patch(self, views, 'job_definitions', [{
+            'name': benchmark.FOLDER_NAME,
+            'regex': 'system-tests-.*'
+        }])
+        patch(self, views, 'menu', FakeMenu())
+        patch(self, ajax, 'poller', poller.BuildPoller(size=20,
+                                                       interval=3600,
+                                                       idle_interval=3600,
+                                                       watch_timeout=3600,
+                                                       max_workers=1,
+                                                       max_waiters=10))
+        patch(self, store, '_cause_index_updated_at', {})
+        patch(self, cache, 'local_cache', cache.LocalCache(1024 * 1024))
+        self.factory = RequestFactory()
+
+
+class SharedResultsTest(ViewTestCase):
+    """Views shouldn't modify results shared by requests through the
+    local cache."""
+
+    def test_build_histories(self):
+        response = views.build(self.factory.get('/'), self.job_name, '29')
+        self.assertEqual(200, response.status_code)
+        for build_number in (27, 25, 23, 21, 19):
+            self.assertIn('/job/{}/{}/'.format(self.job_name, build_number),
+                          response.content.decode('utf-8'))
+        report = store.get_tests_report(self.full_job_name, 29)
+        self.assertIs(report, store.get_tests_report(self.full_job_name, 29))
+        self.assertFalse(any(hasattr(case, 'history')
+                             for suite in report.suites
+                             for case in suite.cases))
+
+    def test_job_builds_invalid_page(self):
+        response = ajax.job_builds(self.factory.get('/', {'page': 'x'}),
+                                   self.job_name)
+        self.assertEqual(200, response.status_code)
+        self.assertIn('/job/{}/30/'.format(self.job_name),
+                      response.content.decode('utf-8'))
+
+    def test_job_builds_reports(self):
+        for page in (1, 2):
+            response = ajax.job_builds(self.factory.get('/', {'page': page}),
+                                       self.job_name)
+            self.assertEqual(200, response.status_code)
+            self.assertIn('% (', response.content.decode('utf-8'))
+        builds = self.jenkins.list_builds_page(self.full_job_name, 10, 20)
+        self.assertIs(builds[0], self.jenkins.list_builds_page(
+                self.full_job_name, 10, 20)[0])
+        self.assertEqual(list(range(10, 0, -1)),
+                         [x['number'] for x in builds])
+        self.assertFalse(any('report' in x for x in builds))
+        version, builds = ajax.poller.get_builds(self.full_job_name)
+        self.assertEqual(1, version)
+        self.assertFalse(any('report' in x for x in builds))
+
+
+class ReportTest(TestCase):
+
+    def setUp(self):
+        data = _report_data()
+        cases = data['suites'][0]['cases']
+        cases.insert(1, dict(cases[0], status='FAILED'))
+        self.report = jenkins.Report(data)
+
+    def test_duplicate_cases(self):
+        cases = self.report.suites[0].cases
+        self.assertEqual(4, len(cases))
+        self.assertEqual('PASSED', cases[0].status)
+        self.assertEqual([0, 2, 3, 4], [x.position for x in cases])
+
+    def test_find_case(self):
+        for report in (self.report, jenkins.Report(self.report.to_dict())):
+            case = report.suites[0].cases[1]
+            self.assertEqual((0, case), report.find_case(case.id))
+            self.assertEqual(2, case.position)
+            self.assertEqual((None, None), report.find_case('0' * 16))
+            self.assertTrue(report.has_suite('suite'))
+            self.assertFalse(report.has_suite('other'))
+            # The index is built once.
+            self.assertIs(report._get_index(), report._get_index())
+
+
+class TestViewTest(ViewTestCase):
+
+    def _test_view(self, build_number, case_id, suite_name='suite_1'):
+        return views.test(self.factory.get('/'), self.job_name,
+                          str(build_number), suite_name, case_id)
+
+    def test_case(self):
+        views.build(self.factory.get('/'), self.job_name, '29')
+        report = store.get_tests_report(self.full_job_name, 29)
+        case = report.suites[1].cases[3]
+        queries = len(self.jenkins.queries)
+        response = self._test_view(29, case.id)
+        self.assertEqual(200, response.status_code)
+        content = response.content.decode('utf-8')
+        self.assertIn(case.name, content)
+        # The duration is rendered in seconds.
+        self.assertIn('<td>{}</td>'.format(case.duration_seconds), content)
+        # Only the case itself is retrieved.
+        self.assertEqual(queries + 1, len(self.jenkins.queries))
+
+    def test_not_found(self):
+        case = store.get_tests_report(self.full_job_name,
+                                      29).suites[1].cases[3]
+        self.assertEqual(404, self._test_view(29, '0' * 16).status_code)
+        self.assertEqual(404, self._test_view(29, case.id,
+                                              'suite_9').status_code)
+        self.assertEqual(404, self._test_view(30, case.id).status_code)
+        self.assertEqual(404, self._test_view(31, case.id).status_code)
+
+    def test_stale_position(self):
+        report = store.get_tests_report(self.full_job_name, 29)
+        case = report.suites[1].cases[3]
+        case.position = 100
+        self.assertEqual(404, self._test_view(29, case.id).status_code)
+        case.position = 2
+        self.assertEqual(404, self._test_view(29, case.id).status_code)
+
+
+class MapWithDeadlineTest(TestCase):
+
+    def setUp(self):
+        self.pool = ThreadPool(1)
+        self.addCleanup(self.pool.terminate)
+
+    def test_deadline_per_call(self):
+        # The second call starts once the first one completes.
+        self.assertEqual([0.2, 0.2], map_with_deadline(
+                self.pool, lambda x: time.sleep(x) or x, [0.2, 0.2], 0.3))
+
+    def test_pending(self):
+        self.assertEqual([0, PENDING], map_with_deadline(
+                self.pool, lambda x: time.sleep(x) or x, [0, 0.5], 0.2))
+
+    def test_pending_not_started(self):
+        map_with_deadline(self.pool, time.sleep, [0.5], 0)
+        self.assertEqual([PENDING], map_with_deadline(
+                self.pool, lambda x: x, [1], 0.2))
+
+
+class NightlyBuildTest(TestCase):
+
+    def test_concurrent_lookups_shared(self):
+        calls = []
+
+        def find_nightly_build(job):
+            calls.append(job['name'])
+            time.sleep(0.2)
+            return jenkins.Build(_build_data(1))
+
+        patch(self, views, 'find_nightly_build', find_nightly_build)
+        results = []
+        threads = [threading.Thread(
+                target=lambda: results.append(
+                        views.find_nightly_build_or_none({'name': 'job'})))
+                   for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(['job'], calls)
+        self.assertEqual([_build_data(1)] * 3, results)
+
+
+class MetricsTest(TestCase):
+
+    def _histogram(self):
+        histogram = metrics.Histogram('jetere_test_seconds', 'A test.',
+                                      ('path',), buckets=(1, 2.5))
+        self.addCleanup(metrics._metrics.pop, histogram.name)
+        return histogram
+
+    def test_histogram(self):
+        histogram = self._histogram()
+        for value in (0.5, 1, 3):
+            histogram.observe(value, path='a"b\\c\nd')
+        histogram.observe(2, path='e')
+        self.assertEqual('\n'.join([
+            '# HELP jetere_test_seconds A test.',
+            '# TYPE jetere_test_seconds histogram',
+            r'jetere_test_seconds_bucket{path="a\"b\\c\nd",le="1"} 2',
+            r'jetere_test_seconds_bucket{path="a\"b\\c\nd",le="2.5"} 2',
+            r'jetere_test_seconds_bucket{path="a\"b\\c\nd",le="+Inf"} 3',
+            r'jetere_test_seconds_sum{path="a\"b\\c\nd"} 4.5',
+            r'jetere_test_seconds_count{path="a\"b\\c\nd"} 3',
+            'jetere_test_seconds_bucket{path="e",le="1"} 0',
+            'jetere_test_seconds_bucket{path="e",le="2.5"} 1',
+            'jetere_test_seconds_bucket{path="e",le="+Inf"} 1',
+            'jetere_test_seconds_sum{path="e"} 2',
+            'jetere_test_seconds_count{path="e"} 1'
+        ]), histogram.render())
+
+    def test_export(self):
+        self._histogram().observe(1, path='a')
+        response = self.client.get('/metrics/')
+        self.assertEqual(200, response.status_code)
+        self.assertIn('\njetere_test_seconds_count{path="a"} 1\n',
+                      response.content.decode('utf-8'))
+
+    def test_server_timing(self):
+        def get_response(request):
+            with metrics.UpstreamRequest('jenkins', 'build') as request:
+                time.sleep(0.01)
+                request.status = 200
+            return http.HttpResponse()
+
+        response = metrics.TimingMiddleware(get_response)(
+                RequestFactory().get('/'))
+        timings = [x.split(';dur=') for x in
+                   response['Server-Timing'].split(', ')]
+        self.assertEqual(['jenkins', 'total'], [x[0] for x in timings])
+        self.assertGreaterEqual(float(timings[0][1]), 10)
+        self.assertGreaterEqual(float(timings[1][1]), float(timings[0][1]))
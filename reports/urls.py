@@ -6,6 +6,7 @@ from . import ajax
 urlpatterns = [
     url(r'^$', views.index, name='index'),
     url(r'^ajax/$', ajax.unit_tests, name='unit_tests'),
+    url(r'^metrics/$', views.export_metrics, name='metrics'),
 
     # TODO: support numbers as well in this regex
     url(r'^job/(?P<job_name>[\w.-]+)/$',
@@ -14,13 +15,25 @@ urlpatterns = [
     url(r'^job/(?P<job_name>[\w.-]+)/ajax/$',
         ajax.job_builds,
         name='job_builds'),
+    url(r'^job/(?P<job_name>[\w.-]+)/analytics/$',
+        views.job_analytics,
+        name='job_analytics'),
+    url(r'^job/(?P<job_name>[\w.-]+)/nightly/ajax/$',
+        ajax.nightly_build,
+        name='nightly_build'),
 
     url(r'^job/(?P<job_name>[\w.-]+)/(?P<build_number>[0-9]+)/$',
         views.build,
         name='build'),
+    url(r'^job/(?P<job_name>[\w.-]+)/(?P<base_number>[0-9]+)\.\.\.(?P<build_number>[0-9]+)/$',  # NOQA
+        views.compare_builds,
+        name='compare'),
 
-    url(r'^job/(?P<job_name>[\w.-]+)/(?P<build_number>[0-9]+)/(?P<suite_name>[\w.-]+)/(?P<case_index>[0-9]+)/$',  # NOQA
+    url(r'^job/(?P<job_name>[\w.-]+)/(?P<build_number>[0-9]+)/(?P<suite_name>[\w.-]+)/(?P<case_id>[0-9a-f]+)/$',  # NOQA
         views.test,
         name='test'),
+    url(r'^job/(?P<job_name>[\w.-]+)/(?P<build_number>[0-9]+)/(?P<suite_name>[\w.-]+)/(?P<case_id>[0-9a-f]+)/manager-logs/$',  # NOQA
+        ajax.manager_logs,
+        name='manager_logs'),
 ]
 
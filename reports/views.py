@@ -1,15 +1,22 @@
 import logging
+from multiprocessing.pool import ThreadPool
 import re
 from functools import wraps
 
-import urllib2
-
 from django import http
 from django.shortcuts import render
 from django.views.defaults import page_not_found
 
 from . import models
+from . import analytics
+from . import cache
+from . import compare
+from . import history
 from . import jenkins
+from . import metrics
+from . import store
+from .concurrency import map_with_deadline, PENDING
+from .menu import instance as menu
 from .jenkins import client as jenkins_client
 from .config import instance as config
 
@@ -18,7 +25,21 @@ logger = logging.getLogger('django')
 job_definitions = config['jenkins']['job_definitions']
 
 DEFAULT_MAX_BUILDS = 20
+DEFAULT_ANALYTICS_BUILDS = 50
+MAX_ANALYTICS_BUILDS = 200
 NIGHTLY_BUILD_SEARCH_LIMIT = 20
+NIGHTLY_BUILD_DEADLINE = config['jenkins'].get('nightly_build_deadline', 5)
+
+# Missing tests history columns appended by a single view, the others are
+# appended by later views (or by the sync_builds command).
+HISTORY_UPDATES_PER_VIEW = 5
+
+# Shared by all requests in order to cap concurrent nightly build lookups.
+_nightly_build_pool = ThreadPool(
+        config['jenkins'].get('nightly_build_workers', 8))
+
+# Concurrent lookups of a job's nightly build share a single lookup.
+_nightly_build_lookups = cache.SingleFlight()
 
 
 def _get_jobs():
@@ -27,14 +48,8 @@ def _get_jobs():
 
 def _get_default_template_vars():
     # TODO: auto inject view argument as template args
-    jobs_list = []
-    for x in job_definitions:
-        job = jenkins_client.get_job(x['name'])
-        nested_jobs = [a['name'] for a in list_nested_jobs(job, x['regex'])]
-        jobs = [jenkins_client.get_job('{}/{}'.format(job['name'], a)) for a in nested_jobs]
-        jobs_list.extend(jobs)
     return {
-            'jobs_list': jobs_list
+            'jobs_list': menu.get_jobs()
         }
 
 
@@ -58,8 +73,13 @@ def render_me(html_file, inject_default_template_vars=False):
     return decorator
 
 
-def list_nested_jobs(job, regex):
-    return [x for x in job['jobs'] if re.match(regex, x['name'])]
+def int_param(request, name, default):
+    """Return an integer query parameter, or default if it's missing or
+    not an integer."""
+    try:
+        return int(request.GET.get(name, default))
+    except ValueError:
+        return default
 
 
 def find_job_definition(job_name):
@@ -75,24 +95,44 @@ def find_nightly_build(job):
     job_name = job['name']
     job_def = find_job_definition(job_name)
     full_job_name = '{}/{}'.format(job_def['name'], job_name)
-    build_numbers = [x['number'] for x in job['builds']]
-    for build_number in build_numbers[:NIGHTLY_BUILD_SEARCH_LIMIT]:
-        b = jenkins_client.get_build(full_job_name, build_number)
+    builds = store.list_builds(full_job_name, size=NIGHTLY_BUILD_SEARCH_LIMIT)
+    for b in builds:
         if b.started_by in (jenkins.TIMER_USER, jenkins.SCM_CHANGE):
             try:
-                b['report'] = jenkins_client.get_tests_report(full_job_name,
-                                                              build_number)
+                b['report'] = store.get_tests_report(full_job_name,
+                                                     b['number'])
             except jenkins.JenkinsResourceNotFound:
                 pass
             return b
     return None
 
 
+def find_nightly_build_or_none(job):
+    """Lookups still running for the job (e.g. those of the index page
+    which are pending) are shared rather than made again."""
+    try:
+        return _nightly_build_lookups.do(job['name'],
+                                         lambda: find_nightly_build(job))
+    except Exception as e:
+        logger.error('Error finding nightly build of "{}": {}'.format(
+                job['name'], str(e)))
+        return None
+
+
 @render_me('main.html', inject_default_template_vars=True)
 def index(request, jobs_list, **_):
-    for j in jobs_list:
-        nightly_build = find_nightly_build(j)
-        if nightly_build:
+    """Nightly builds are looked up concurrently. Jobs whose nightly build
+    lookup doesn't complete within NIGHTLY_BUILD_DEADLINE seconds (see
+    map_with_deadline) are rendered as pending and loaded by the page
+    using ajax.nightly_build, which joins the running lookup."""
+    nightly_builds = map_with_deadline(_nightly_build_pool,
+                                       find_nightly_build_or_none,
+                                       jobs_list,
+                                       NIGHTLY_BUILD_DEADLINE)
+    for j, nightly_build in zip(jobs_list, nightly_builds):
+        if nightly_build is PENDING:
+            j['nightly_build_pending'] = True
+        elif nightly_build:
             j['nightly_build'] = nightly_build
 
 
@@ -104,58 +144,14 @@ def job(request, job_name):
                 request, ValueError('Unknown job: {}'.format(job_name)))
     full_job_name = '{}/{}'.format(job_def['name'], job_name)
     job = jenkins_client.get_job(full_job_name)
-    last_build_number = job['lastBuild']['number']
-    builds = jenkins_client.get_builds(full_job_name,
-                                         last_build_number,
-                                         size=DEFAULT_MAX_BUILDS)
+    # Builds are listed by ajax.job_builds.
     return {
         'job': job,
         'job_name': job_name,
-        'builds': builds
+        'page': max(int_param(request, 'page', 1), 1)
     }
 
 
-def get_last_timer_builds(full_job_name, last_build_number):
-    timer_builds = []
-    counter = 0
-    while len(timer_builds) < 5:
-        last_build_number -= 1
-        if last_build_number == 0:
-            break
-        counter += 1
-        b = jenkins_client.get_build(full_job_name, last_build_number)
-        if b and b.is_timer_build:
-            timer_builds.append(b)
-        if counter == 100:
-            raise RuntimeError(
-                    'get_last_timer_builds exceeded 100 build retrievals!')
-    return timer_builds
-
-
-def generate_tests_history(report, nightly_builds):
-    tests = {}
-
-    def _collect_tests_from_suite(suite, build_number):
-        for case in suite.get('cases', []):
-            test_name = '{}.{}.{}'.format(suite['name'], case['className'], case['name'])
-            if test_name not in tests:
-                tests[test_name] = []
-            tests[test_name].append({
-                'build_number': build_number,
-                'case': case
-            })
-
-    for b in nightly_builds:
-        if b.report:
-            for s in b.report.get('suites', []):
-                _collect_tests_from_suite(s, b['number'])
-
-    for s in report.get('suites', []):
-        for c in s.get('cases', []):
-            test_name = '{}.{}.{}'.format(s['name'], c['className'], c['name'])
-            setattr(c, 'history', tests.get(test_name))
-
-
 @render_me('build.html')
 def build(request, job_name, build_number):
     build_number = int(build_number)
@@ -164,79 +160,131 @@ def build(request, job_name, build_number):
         return page_not_found(
                 request, ValueError('Unknown job: {}'.format(job_name)))
     full_job_name = '{}/{}'.format(job_def['name'], job_name)
-    report_tree = 'passCount,failCount,skipCount,suites[name,cases[name,className,status,duration]]'  # NOQA
+    logger.info('Getting test report for {}/{}'.format(
+            full_job_name, build_number))
     try:
-        logger.info('Getting test report for {}/{}'.format(
-                full_job_name, build_number))
-        report = jenkins_client.get_tests_report(full_job_name,
-                                                 build_number,
-                                                 tree=report_tree)
-        logger.info('Getting last timer builds for {}/{}'.format(
-                full_job_name, build_number))
-        nightly_builds = get_last_timer_builds(full_job_name, build_number)
-        for b in nightly_builds:
-            logger.info('Getting test report for timer build {}/{}'.format(
-                    full_job_name, b['number']))
-            try:
-                r = jenkins_client.get_tests_report(full_job_name,
-                                                    b['number'],
-                                                    tree=report_tree)
-                setattr(b, 'report', r)
-            except jenkins.JenkinsResourceNotFound:
-                setattr(b, 'report', None)
-        logger.info('Generating tests history for test report {}/{}'.format(
-                full_job_name, build_number))
-        generate_tests_history(report, nightly_builds)
+        report = store.get_tests_report(full_job_name, build_number)
     except jenkins.JenkinsResourceNotFound:
         report = None
+    # Reports may be shared by requests (see cache_result), so histories
+    # are kept by case id rather than set on cases.
+    histories = {}
+    if report is not None:
+        logger.info('Getting tests history for {}/{}'.format(
+                full_job_name, build_number))
+        timer_builds = store.last_timer_builds(full_job_name,
+                                               build_number,
+                                               count=history.HISTORY_SIZE)
+        store.update_history(full_job_name,
+                             timer_builds,
+                             max_builds=HISTORY_UPDATES_PER_VIEW)
+        tests_history = history.get_history(full_job_name, timer_builds)
+        for suite in report.suites:
+            for case in suite.cases:
+                histories[case.id] = tests_history.get(suite, case)
     return {
         'job_name': job_name,
         'build_number': build_number,
         'report': report,
+        'histories': histories,
         'full_build_log_url': jenkins_client.get_full_build_log_url(
                 full_job_name, build_number)
     }
 
 
-def find_suite(report, suite_name):
-    for suite in report['suites']:
-        if suite['name'] == suite_name:
-            return suite
-    return None
-
-
-def get_manager_logs_for_test(build_number, case):
-    url = 'http://cloudify-tests-logs.s3.amazonaws.com/{build_number}/{build_number}-{class_name}-{test_name}/links.html'.format(
-        build_number=build_number,
-        class_name=case.short_class_name,
-        test_name=case['name'])
-    try:
-        response = urllib2.urlopen(url)
-    except urllib2.HTTPError as e:
-        return None
-    else:
-        return response.read()
+@render_me('analytics.html')
+def job_analytics(request, job_name):
+    job_def = find_job_definition(job_name)
+    if not job_def:
+        return page_not_found(
+                request, ValueError('Unknown job: {}'.format(job_name)))
+    full_job_name = '{}/{}'.format(job_def['name'], job_name)
+    builds_count = min(max(int_param(request,
+                                     'builds',
+                                     DEFAULT_ANALYTICS_BUILDS), 1),
+                       MAX_ANALYTICS_BUILDS)
+    timer_builds = store.last_timer_builds(full_job_name, count=builds_count)
+    store.update_history(full_job_name,
+                         timer_builds,
+                         max_builds=HISTORY_UPDATES_PER_VIEW)
+    identities, columns = history.get_columns(full_job_name, timer_builds)
+    trends = analytics.TestTrends(
+            *analytics.status_matrix(identities, columns))
+    return {
+        'job_name': job_name,
+        'build_numbers': trends.build_numbers,
+        'tests': trends.top()
+    }
 
 
 @render_me('test.html')
-def test(request, job_name, build_number, suite_name, case_index):
+def test(request, job_name, build_number, suite_name, case_id):
+    """Only the requested case is retrieved from Jenkins, using the build's
+    report (as shown by the build page) to find its position."""
     job_def = find_job_definition(job_name)
     if not job_def:
         return page_not_found(
                 request, ValueError('Unknown job: {}'.format(job_name)))
     full_job_name = '{}/{}'.format(job_def['name'], job_name)
-    report = jenkins_client.get_tests_report(full_job_name, build_number)
-    suite = find_suite(report, suite_name)
-    if not suite:
+    try:
+        report = store.get_tests_report(full_job_name, int(build_number))
+    except jenkins.JenkinsResourceNotFound as e:
+        return page_not_found(request, e)
+    if not report.has_suite(suite_name):
         return page_not_found(
             request, ValueError('Suite not found: "{}"'.format(suite_name)))
-    case = suite['cases'][int(case_index)]
+    suite_position, case = report.find_case(case_id)
+    if case is None:
+        return page_not_found(
+            request, ValueError('Test not found: "{}"'.format(case_id)))
+    try:
+        test_case = jenkins_client.get_test_case(full_job_name,
+                                                 build_number,
+                                                 suite_position,
+                                                 case.position)
+    except jenkins.JenkinsResourceNotFound as e:
+        return page_not_found(request, e)
+    cases = [x for suite in test_case.suites for x in suite.cases]
+    # Positions may be wrong for reports stored without them.
+    if not cases or cases[0].id != case_id:
+        return page_not_found(
+            request, ValueError('Test not found: "{}"'.format(case_id)))
+    case = cases[0]
     return {
         'job_name': job_name,
         'build_number': build_number,
         'suite_name': suite_name,
         'case': case,
         'full_build_log_url': jenkins_client.get_full_build_log_url(
-                full_job_name, build_number),
-        'manager_logs': get_manager_logs_for_test(build_number, case)
+                full_job_name, build_number)
+    }
+
+
+@render_me('compare.html')
+def compare_builds(request, job_name, base_number, build_number):
+    job_def = find_job_definition(job_name)
+    if not job_def:
+        return page_not_found(
+                request, ValueError('Unknown job: {}'.format(job_name)))
+    full_job_name = '{}/{}'.format(job_def['name'], job_name)
+    try:
+        diff = compare.comparer.compare(full_job_name,
+                                        int(base_number),
+                                        int(build_number))
+    except jenkins.JenkinsResourceNotFound:
+        diff = None
+    return {
+        'job_name': job_name,
+        'base_number': base_number,
+        'build_number': build_number,
+        'diff': diff
     }
+
+
+def export_metrics(request):
+    """Metrics of this process in the Prometheus text exposition format."""
+    local_cache_stats = cache.local_cache.get_stats()
+    metrics.local_cache_entries.set(local_cache_stats['entries'])
+    metrics.local_cache_bytes.set(local_cache_stats['size'])
+    return http.HttpResponse(metrics.render(),
+                             content_type='text/plain; version=0.0.4')